@@ -1,171 +1,1341 @@
-import sys
-import os
-import sublime, sublime_plugin
-
-import subprocess
-import socket
-import struct
-import time
-import threading
-
-
-if os.name == 'nt':
-    from ctypes import windll, create_unicode_buffer
-
-
-def add_to_path(path):
-    # Python 2.x on Windows can't properly import from non-ASCII paths, so
-    # this code added the DOC 8.3 version of the lib folder to the path in
-    # case the user's username includes non-ASCII characters
-    if os.name == 'nt':
-        buf = create_unicode_buffer(512)
-        if windll.kernel32.GetShortPathNameW(path, buf, len(buf)):
-            path = buf.value
-
-    if path not in sys.path:
-        sys.path.append(path)
-
-
-lib_folder = os.path.join(sublime.packages_path(), 'IPython', 'lib')
-add_to_path(lib_folder)
-
-# import protocol
-# reload(protocol)
-from protocol import Connection
-
-def load_settings():
-    return sublime.load_settings("IPython.sublime-settings")
-
-def plugin_dir():
-    return os.path.join(sublime.packages_path(), 'IPython')
-
-def find_python(settings):    
-    if settings.has("python"):
-        python = settings.get("python")
-        if os.path.exists(python):
-            return settings.get("python")
-        else:
-            raise RuntimeError("python setting points to non existing file [%s]" % python)
-
-    executable = 'pythonw.exe' if os.name == 'nt' else 'python'
-    paths = os.environ.get("PATH").split(os.pathsep)
-    for path in paths:
-        python = os.path.join( os.path.expandvars(path), executable )
-        if os.path.exists(python):
-            return python
-
-    raise RuntimeError("unable to find [%s] in path [%s]" % (executable, os.environ.get("PATH")))
-
-def start_server_process(port):
-    # print directory
-    # shell out to the 2.7 python included in the OS
-    settings = load_settings()
-
-    python = find_python(settings)
-
-    cmd = [ python, 
-            os.path.join( plugin_dir(), "support", "ipython_send.py"), "-s", "-p", str(port)
-            ]
-
-    if settings.has("daemon_args"):
-        for arg in settings.get("daemon_args"):
-            cmd.append(arg)
-
-    print "starting server process [%s]" % ' '.join(cmd)
-
-    if os.name != 'nt':
-        cmd.append("--daemon")
-
-
-    server_process = subprocess.Popen(cmd,
-            stdout = subprocess.PIPE, stderr = subprocess.PIPE)    
-
-    if os.name != 'nt':
-        (stdout,stderr) = server_process.communicate()
-
-        exitcode = server_process.wait()
-        
-        if exitcode != 0:
-            for out in [stdout, stderr]:
-                if out is not None:
-                    print out
-            raise RuntimeError("Unable to start daemon process exitcode : %d" % exitcode)
-    else:
-        t = threading.Thread(target = server_process.communicate)
-        t.daemon = True
-        t.start()
-
-def attempt_new_socket(port, start_server = True):
-    print "attempt_new_socket(%d)" % port
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect(("127.0.0.1", port))
-        return s
-    except socket.error as err:
-        if start_server: 
-            start_server_process(port)
-            time.sleep(1)
-            return attempt_new_socket( port, start_server = False )
-        else:
-            raise err
-
-class Client:   
-    def __init__(self, port = 48721):
-        self.port = port
-
-    def execute(self, code, callback = None):        
-
-        s = attempt_new_socket(self.port)
-        try:
-            connection = Connection(s)
-            connection.write_message( 1, str(code))
-            (msgtype, payload) = connection.read_message()
-
-            success = msgtype == 2
-            print "[%s] [%s]" % (msgtype, payload)
-            if callback is not None:
-                callback(success, payload)
-            
-            return success
-        finally:
-            s.close()
-
-class SendToIpythonCommand(sublime_plugin.TextCommand):
- 
-    def run(self, edit):
-        """
-            send the current selection (or whole buffer if no selection)
-            to the ipython process.
-        """ 
-        
-        if not hasattr(self, 'output_view' ):
-            self.output_view = self.view.window().get_output_panel("ipython")
-            self.output_view.set_syntax_file(os.path.join(plugin_dir(),"ipython_output.tmLanguage"))
-            
-
-        sel = self.view.sel()
-        if sel[0]:
-            text = '\n'.join(self.view.substr(reg) for reg in sel)
-        else:
-            size = self.view.size()
-            text = self.view.substr(sublime.Region(0, size))
-
-        client = Client()
-
-        if client.execute(text, callback = self.on_output):
-            self.view.set_status( "ipython", "send to ipython - success" )
-        else:
-            self.view.set_status( "ipython", "send to ipython - failure" )
- 
-
-    def on_output(self, success, payload):
-
-        self.output_view.set_read_only(False)
-        edit = self.output_view.begin_edit()
-        self.output_view.insert(edit, self.output_view.size(), payload)
-        self.output_view.end_edit(edit)
-        self.output_view.set_read_only(True)
-
-        self.output_view.show(self.output_view.size())
-                
-        self.view.window().run_command("show_panel", {"panel": "output.ipython"})
\ No newline at end of file
+import sys
+import os
+import sublime, sublime_plugin
+
+import subprocess
+import socket
+import struct
+import time
+import threading
+import select
+import Queue
+import tempfile
+import codecs
+import stat
+from json import loads, dumps
+
+
+if os.name == 'nt':
+    from ctypes import windll, create_unicode_buffer
+
+
+def add_to_path(path):
+    # Python 2.x on Windows can't properly import from non-ASCII paths, so
+    # this code added the DOC 8.3 version of the lib folder to the path in
+    # case the user's username includes non-ASCII characters
+    if os.name == 'nt':
+        buf = create_unicode_buffer(512)
+        if windll.kernel32.GetShortPathNameW(path, buf, len(buf)):
+            path = buf.value
+
+    if path not in sys.path:
+        sys.path.append(path)
+
+
+lib_folder = os.path.join(sublime.packages_path(), 'IPython', 'lib')
+add_to_path(lib_folder)
+
+# import protocol
+# reload(protocol)
+from protocol import Connection, SocketDisconnected, MSG_EXECUTE, MSG_OK, MSG_ERROR, MSG_DONE, \
+                     MSG_MIME, MSG_TRUNCATED, MSG_FETCH, MSG_INTERRUPT, MSG_TIMEOUT, \
+                     MSG_STATS, MSG_BATCH, MSG_CELL, \
+                     FLAG_STREAM, FLAG_OPTIONS, pack_options, \
+                     unpack_mime
+
+def load_settings():
+    return sublime.load_settings("IPython.sublime-settings")
+
+class SettingsSnapshot(dict):
+    """
+        a copy of the settings for the worker and reader threads, sublime
+        text 2 only allows set_timeout off the main thread
+    """
+    keys = ["python", "daemon_args", "daemon_start_timeout", "transport", "compression",
+            "mime_types", "open_images", "output_limit", "execute_timeout", "timeout_policy",
+            "coalesce_sends", "socket_activation", "start_daemon_on_load"]
+
+    def has(self, key):
+        return key in self
+
+settings_snapshot = SettingsSnapshot()
+
+def snapshot_settings():
+    """ call on the main thread before anything that may start the daemon """
+    settings = load_settings()
+    for key in SettingsSnapshot.keys:
+        if settings.has(key):
+            settings_snapshot[key] = settings.get(key)
+        else:
+            settings_snapshot.pop(key, None)
+
+def plugin_dir():
+    return os.path.join(sublime.packages_path(), 'IPython')
+
+def cache_dir():
+    """ where the plugin keeps what it has worked out between sessions """
+    if hasattr(sublime, "cache_path"):
+        return os.path.join(sublime.cache_path(), "IPython")
+    return os.path.join(os.path.dirname(sublime.packages_path()), "Cache", "IPython")
+
+# the daemon is python 2 and needs IPython's 0.12/0.13 kernel manager
+PYTHON_PROBE = "import sys; assert sys.version_info[0] == 2, 'python ' + sys.version.split()[0]; " \
+               "import IPython.zmq.blockingkernelmanager"
+
+def python_names():
+    if os.name == 'nt':
+        return ['pythonw.exe']
+    return ['python', 'python2', 'python2.7', 'python3']
+
+def virtualenv_python(env):
+    if os.name == 'nt':
+        return os.path.join(env, 'Scripts', 'pythonw.exe')
+    return os.path.join(env, 'bin', 'python')
+
+def python_search_path():
+    return [os.path.expandvars(path) for path in os.environ.get("PATH", "").split(os.pathsep) if path]
+
+def python_candidates(settings):
+    """
+        interpreters to try in order of preference, the "python" setting
+        (an interpreter or a virtualenv) if there is one, else the active
+        virtualenv followed by python_names() along PATH
+    """
+    if settings.has("python"):
+        python = os.path.expanduser(os.path.expandvars(settings.get("python")))
+        if os.path.isdir(python):
+            python = virtualenv_python(python)
+        if not os.path.exists(python):
+            raise RuntimeError("python setting points to non existing file [%s]" % python)
+        return [python]
+
+    candidates = []
+    if os.environ.get("VIRTUAL_ENV"):
+        candidates.append(virtualenv_python(os.environ["VIRTUAL_ENV"]))
+    for path in python_search_path():
+        for name in python_names():
+            candidates.append(os.path.join(path, name))
+
+    # python, python2 and python2.7 are often the same interpreter
+    seen = set()
+    found = []
+    for python in candidates:
+        real = os.path.realpath(python)
+        if real not in seen and os.path.isfile(real):
+            seen.add(real)
+            found.append(python)
+    return found
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def python_cache_key(settings):
+    """
+        changes with the "python" setting, the active virtualenv, PATH and
+        the mtime of anything on it, e.g. when an interpreter is installed
+    """
+    paths = python_search_path()
+    return [settings.get("python"), os.environ.get("VIRTUAL_ENV"),
+            [[path, modified_time(path)] for path in paths]]
+
+def probe_python(python):
+    """ None if python can run the daemon, else the reason it can't """
+    try:
+        process = subprocess.Popen([python, "-c", PYTHON_PROBE],
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        (stdout, stderr) = process.communicate()
+    except OSError as err:
+        return str(err)
+    if process.returncode == 0:
+        return None
+    lines = stderr.strip().splitlines()
+    if lines:
+        return lines[-1]
+    return "exit code %d" % process.returncode
+
+python_cache_lock = threading.Lock()
+resolved_python = None
+
+def python_cache_file():
+    return os.path.join(cache_dir(), "python.json")
+
+def read_python_cache():
+    try:
+        f = open(python_cache_file())
+        try:
+            return loads(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def write_python_cache(entry):
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        f = open(python_cache_file(), "w")
+        try:
+            f.write(dumps(entry))
+        finally:
+            f.close()
+    except (IOError, OSError) as err:
+        print "unable to cache python : %s" % err
+
+def forget_python():
+    """ the cached interpreter failed to start the daemon, look again next time """
+    global resolved_python
+    python_cache_lock.acquire()
+    try:
+        resolved_python = None
+        if os.path.exists(python_cache_file()):
+            os.remove(python_cache_file())
+    finally:
+        python_cache_lock.release()
+
+def find_python(settings):
+    """
+        the first of python_candidates() that can import what the daemon
+        needs, remembered in cache_dir() until python_cache_key() or the
+        interpreter's mtime changes
+    """
+    global resolved_python
+    python_cache_lock.acquire()
+    try:
+        key = python_cache_key(settings)
+        if resolved_python is None:
+            resolved_python = read_python_cache()
+        entry = resolved_python
+        if entry is not None and entry.get("key") == key and \
+                modified_time(entry["python"]) == entry.get("mtime"):
+            return entry["python"]
+
+        rejected = []
+        for python in python_candidates(settings):
+            reason = probe_python(python)
+            if reason is None:
+                resolved_python = {"key": key, "python": python, "mtime": modified_time(python)}
+                write_python_cache(resolved_python)
+                return python
+            print "not using %s : %s" % (python, reason)
+            rejected.append("%s (%s)" % (python, reason))
+
+        if rejected:
+            raise RuntimeError("no python that can import IPython.zmq, tried %s" % ", ".join(rejected))
+        raise RuntimeError("unable to find [%s] in path [%s]" % (
+            ", ".join(python_names()), os.environ.get("PATH")))
+    finally:
+        python_cache_lock.release()
+
+def runtime_dir():
+    """ where the daemon's socket and ready file go, only this user may use it """
+    if os.name == 'nt':
+        # already per user
+        return tempfile.gettempdir()
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "ipython-sublime")
+    return os.path.join(tempfile.gettempdir(), "ipython-sublime-%d" % os.getuid())
+
+def make_runtime_dir():
+    """
+        creates runtime_dir() if need be and makes sure nobody else could
+        have put a socket of their own in it, in /tmp anyone could have
+        created it first
+    """
+    directory = runtime_dir()
+    if os.name == 'nt':
+        return directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise RuntimeError("%s isn't a directory private to this user, remove it and try again" %
+                           directory)
+    return directory
+
+def ready_file_path(port):
+    return os.path.join(runtime_dir(), "daemon-%d.ready" % port)
+
+def unix_socket_path(port):
+    return os.path.join(runtime_dir(), "daemon-%d.sock" % port)
+
+def daemon_address(port):
+    """
+        the unix socket path to reach the daemon for port on, or
+        ("127.0.0.1", port) where unix sockets aren't available or the
+        "transport" setting asks for tcp
+    """
+    transport = settings_snapshot.get("transport", "auto")
+    if transport in ("unix", "auto") and hasattr(socket, "AF_UNIX"):
+        make_runtime_dir()
+        return unix_socket_path(port)
+    return ("127.0.0.1", port)
+
+def connect_socket(address):
+    if isinstance(address, basestring):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.connect(address)
+    except socket.error:
+        s.close()
+        raise
+    return s
+
+def listen_socket(address):
+    """
+        a socket listening on address for the daemon to inherit, so
+        connects succeed (and queue) while it is still starting up
+    """
+    if isinstance(address, basestring):
+        make_runtime_dir()
+        if os.path.exists(address):
+            # left behind by a daemon that has gone, we couldn't connect
+            os.remove(address)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind(address)
+        if isinstance(address, basestring):
+            os.chmod(address, 0600)
+        s.listen(128)
+    except (socket.error, OSError):
+        s.close()
+        raise
+    return s
+
+def use_socket_activation():
+    return os.name != 'nt' and settings_snapshot.get("socket_activation", True)
+
+def start_server_process(port, listener = None):
+    """
+        launches the daemon and returns the path of the file it will write
+        "ready" (or "error <message>") to once it is listening. With a
+        listener, from listen_socket(), the daemon serves on that instead
+        of binding its own.
+    """
+    # print directory
+    # shell out to the 2.7 python included in the OS
+    settings = settings_snapshot
+
+    python = find_python(settings)
+
+    make_runtime_dir()
+    ready_file = ready_file_path(port)
+    if os.path.exists(ready_file):
+        os.remove(ready_file)
+
+    cmd = [ python, 
+            os.path.join( plugin_dir(), "support", "ipython_send.py"), "-s", "-p", str(port),
+            "--ready-file", ready_file
+            ]
+
+    address = daemon_address(port)
+    if isinstance(address, basestring):
+        cmd.extend(["--unix-socket", address])
+    if listener is not None:
+        cmd.extend(["--listen-fd", str(listener.fileno())])
+
+    if settings.has("daemon_args"):
+        for arg in settings.get("daemon_args"):
+            cmd.append(arg)
+
+    print "starting server process [%s]" % ' '.join(cmd)
+
+    if os.name != 'nt':
+        cmd.append("--daemon")
+
+
+    server_process = subprocess.Popen(cmd,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE)    
+
+    if os.name != 'nt':
+        (stdout,stderr) = server_process.communicate()
+
+        exitcode = server_process.wait()
+        
+        if exitcode != 0:
+            for out in [stdout, stderr]:
+                if out is not None:
+                    print out
+            raise RuntimeError("Unable to start daemon process exitcode : %d" % exitcode)
+    else:
+        t = threading.Thread(target = server_process.communicate)
+        t.daemon = True
+        t.start()
+
+    return ready_file
+
+def read_ready_file(ready_file):
+    try:
+        f = open(ready_file)
+        try:
+            return f.readline().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def wait_for_server(address, ready_file, timeout):
+    """
+        connects to a daemon that is starting up, retrying with exponential
+        backoff until timeout seconds have passed. Gives up straight away if
+        the daemon reports an error through its ready file.
+    """
+    deadline = time.time() + timeout
+    delay = 0.01
+    while True:
+        status = read_ready_file(ready_file)
+        if status is not None and status.startswith("error"):
+            raise RuntimeError("daemon failed to start : %s" % status[len("error"):].strip())
+
+        try:
+            return connect_socket(address)
+        except socket.error as err:
+            if time.time() + delay > deadline:
+                raise RuntimeError("daemon not listening on %s after %ss : %s" % (address, timeout, err))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def attempt_new_socket(port, start_server = True):
+    print "attempt_new_socket(%d)" % port
+    address = daemon_address(port)
+    try:
+        return connect_socket(address)
+    except socket.error as err:
+        if start_server:
+            try:
+                if use_socket_activation():
+                    listener = listen_socket(address)
+                    try:
+                        ready_file = start_server_process(port, listener)
+                    finally:
+                        # the daemon has its own copy
+                        listener.close()
+                else:
+                    ready_file = start_server_process(port)
+                timeout = settings_snapshot.get("daemon_start_timeout", 10)
+                return wait_for_server(address, ready_file, timeout)
+            except RuntimeError:
+                forget_python()
+                raise
+        else:
+            raise err
+
+# seconds past an execute's timeout to wait for the daemon to report it,
+# it gives an interrupted kernel a few seconds to stop
+REPLY_GRACE = 10
+
+class PendingRequest:
+    """
+        a request that has been sent to the daemon, iterating over it yields
+        (msgtype, payload) for each reply frame as it arrives, a streamed
+        request finishes with MSG_DONE, anything else after its only reply.
+        Alternatively listen() has the frames pushed to a callback.
+    """
+    def __init__(self, request_id, connection, streaming = False):
+        self.request_id = request_id
+        self.connection = connection
+        self.streaming = streaming
+        self.frames = Queue.Queue()
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def is_final(self, msgtype):
+        return not self.streaming or msgtype == MSG_DONE
+
+    def deliver(self, msgtype, payload):
+        self.push(msgtype, payload)
+        return self.is_final(msgtype)
+
+    def fail(self, error):
+        self.push(None, error)
+
+    def push(self, msgtype, payload):
+        self.lock.acquire()
+        try:
+            if self.listener is not None:
+                self.listener(msgtype, payload)
+            else:
+                self.frames.put((msgtype, payload))
+        finally:
+            self.lock.release()
+
+    def listen(self, listener):
+        """
+            calls listener(msgtype, payload) for every frame, including any
+            that already arrived, on the connection's reader thread.
+            listener(None, error) is called if the connection fails.
+        """
+        self.lock.acquire()
+        try:
+            while not self.frames.empty():
+                listener(*self.frames.get())
+            self.listener = listener
+        finally:
+            self.lock.release()
+
+    def __iter__(self):
+        while True:
+            (msgtype, payload) = self.frames.get()
+            if msgtype is None:
+                raise payload
+            yield (msgtype, payload)
+            if self.is_final(msgtype):
+                return
+
+    def wait(self):
+        for frame in self:
+            pass
+        return frame
+
+class DaemonConnection:
+    """
+        one connection to the daemon shared by every execute. With a version
+        2 daemon each request is tagged with an id and pipelined, a reader
+        thread hands replies to whoever is waiting on that id. A version 1
+        daemon gets one request at a time. Either way the connection is
+        reopened on the next request once the daemon has dropped it.
+    """
+    def __init__(self, port):
+        self.port = port
+        # guards connection and pending
+        self.lock = threading.Lock()
+        # held while connecting and for whole round trips with version 1
+        self.lockstep = threading.Lock()
+        self.connection = None
+        self.pending = {}
+        self.next_id = 1
+
+    def request(self, msgtype, payload, flags = 0, options = None):
+        self.lockstep.acquire()
+        try:
+            connection = self._get_connection()
+            if connection.version < 2:
+                if msgtype == MSG_BATCH:
+                    raise RuntimeError("the daemon is too old to run batches")
+                # no flags and so no streaming or options with a version 1 daemon
+                return self._roundtrip(connection, msgtype, payload)
+        finally:
+            self.lockstep.release()
+
+        if options:
+            payload = pack_options(options, payload)
+            flags |= FLAG_OPTIONS
+
+        self.lock.acquire()
+        try:
+            request_id = self.next_id
+            self.next_id += 1
+            pending = PendingRequest(request_id, connection, streaming = bool(flags & FLAG_STREAM))
+            self.pending[request_id] = pending
+        finally:
+            self.lock.release()
+
+        try:
+            connection.write_frame(msgtype, payload, request_id, flags)
+        except (socket.error, SocketDisconnected) as err:
+            self._drop(connection, err)
+        return pending
+
+    def interrupt(self, pending):
+        """
+            asks the daemon to interrupt the kernel running pending's
+            execute, which then finishes with a KeyboardInterrupt error
+        """
+        connection = pending.connection
+        if connection.version < 2:
+            raise RuntimeError("the daemon is too old to interrupt executes")
+        try:
+            connection.write_frame(MSG_INTERRUPT, '', pending.request_id)
+        except (socket.error, SocketDisconnected) as err:
+            self._drop(connection, err)
+            raise
+
+    def _roundtrip(self, connection, msgtype, payload):
+        pending = PendingRequest(0, connection)
+        # a version 1 daemon knows nothing of timeouts, so the socket has to
+        timeout = settings_snapshot.get("execute_timeout", 0)
+        try:
+            connection.sock.settimeout(timeout or None)
+            connection.write_frame(msgtype, payload)
+            (msgtype, request_id, flags, payload) = connection.read_frame()
+            connection.sock.settimeout(None)
+        except (socket.error, SocketDisconnected) as err:
+            self._drop(connection, err)
+            raise
+        pending.deliver(msgtype, payload)
+        return pending
+
+    def connect(self):
+        """ connects now, starting the daemon if need be, rather than on the first request """
+        self.lockstep.acquire()
+        try:
+            self._get_connection()
+        finally:
+            self.lockstep.release()
+
+    def _get_connection(self):
+        connection = self.connection
+        if connection is not None and connection.version < 2 and not is_connection_alive(connection):
+            self._drop(connection, SocketDisconnected("daemon closed the connection"))
+            connection = None
+
+        if connection is None:
+            connection = self._connect()
+            self.lock.acquire()
+            try:
+                self.connection = connection
+            finally:
+                self.lock.release()
+        return connection
+
+    def _connect(self):
+        connection = Connection(attempt_new_socket(self.port))
+        try:
+            connection.sock.settimeout(settings_snapshot.get("daemon_start_timeout", 10))
+            if settings_snapshot.get("compression", False):
+                connection.negotiate()
+            else:
+                connection.negotiate(codecs = [])
+            connection.sock.settimeout(None)
+        except SocketDisconnected:
+            # a version 1 daemon drops the connection on an unknown msgtype
+            connection.sock.close()
+            connection = Connection(attempt_new_socket(self.port, start_server = False))
+
+        if connection.version >= 2:
+            reader = threading.Thread(target = self._read_loop, args = (connection,))
+            reader.daemon = True
+            reader.start()
+        return connection
+
+    def _read_loop(self, connection):
+        try:
+            while True:
+                (msgtype, request_id, flags, payload) = connection.read_frame()
+                self.lock.acquire()
+                try:
+                    pending = self.pending.get(request_id)
+                    if pending is not None and pending.deliver(msgtype, payload):
+                        del self.pending[request_id]
+                finally:
+                    self.lock.release()
+
+                if pending is None:
+                    print "ignoring reply to unknown request [%d]" % request_id
+        except (socket.error, SocketDisconnected) as err:
+            self._drop(connection, err)
+        except Exception as err:
+            # a frame we can't read or a callback that raised, whatever is
+            # waiting on this connection would otherwise wait forever
+            print "dropping the daemon connection : %r" % err
+            self._drop(connection, err)
+
+    def _drop(self, connection, error):
+        self.lock.acquire()
+        try:
+            if self.connection is connection:
+                self.connection = None
+            failed = [p for p in self.pending.values() if p.connection is connection]
+            for pending in failed:
+                del self.pending[pending.request_id]
+        finally:
+            self.lock.release()
+
+        try:
+            connection.sock.close()
+        except socket.error:
+            pass
+        for pending in failed:
+            try:
+                pending.fail(error)
+            except Exception as err:
+                print "error failing request [%d] : %r" % (pending.request_id, err)
+
+def is_connection_alive(connection):
+    # an idle socket should have nothing to read, readable means the daemon
+    # has closed its end (or sent something we never asked for)
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error):
+        return False
+    return not readable
+
+daemon_connections = {}
+daemon_connections_lock = threading.Lock()
+
+def get_daemon_connection(port):
+    daemon_connections_lock.acquire()
+    try:
+        if port not in daemon_connections:
+            daemon_connections[port] = DaemonConnection(port)
+        return daemon_connections[port]
+    finally:
+        daemon_connections_lock.release()
+
+class Client:   
+    def __init__(self, port = 48721):
+        self.port = port
+        self.daemon = get_daemon_connection(port)
+
+    def fetch(self, handle, offset = 0, length = -1):
+        """ a slice of an output the daemon truncated, see truncated_output() """
+        request = {"handle": handle, "offset": offset, "length": length}
+        for (msgtype, payload) in self.daemon.request(MSG_FETCH, dumps(request)):
+            if msgtype != MSG_OK:
+                raise RuntimeError(payload)
+            return payload
+
+    def stats(self):
+        """ the daemon's scheduler metrics by kernel connection file """
+        for (msgtype, payload) in self.daemon.request(MSG_STATS, ''):
+            if msgtype != MSG_OK:
+                raise RuntimeError(payload)
+            return loads(payload)
+
+def execute_options(kernel, timeout = None, priority = "interactive"):
+    options = {'mime': settings_snapshot.get("mime_types", DEFAULT_MIME_TYPES),
+               'output_limit': settings_snapshot.get("output_limit", DEFAULT_OUTPUT_LIMIT),
+               'priority': priority,
+               'coalesce': settings_snapshot.get("coalesce_sends", False)}
+    if timeout:
+        options['timeout'] = timeout
+        options['on_timeout'] = settings_snapshot.get("timeout_policy", "interrupt")
+    if kernel:
+        options['kernel'] = kernel
+    return options
+
+# representations to ask the daemon for, anything other than text/plain
+# arrives as MSG_MIME and is saved to a file
+DEFAULT_MIME_TYPES = ["text/plain", "image/png"]
+MIME_EXTENSIONS = {"image/png": ".png", "text/html": ".html", "application/json": ".json"}
+
+output_dir = None
+
+def session_dir():
+    """ a private temporary directory for this session's output files """
+    global output_dir
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix = "ipython-sublime-output-")
+    return output_dir
+
+def save_mime(mimetype, data):
+    """ writes data to a new file in this session's output directory, returns its path """
+    (fd, path) = tempfile.mkstemp(suffix = MIME_EXTENSIONS.get(mimetype, ""), dir = session_dir())
+    f = os.fdopen(fd, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return path
+
+def open_externally(path):
+    if os.name == 'nt':
+        os.startfile(path)
+    elif sys.platform == 'darwin':
+        subprocess.Popen(["open", path])
+    else:
+        subprocess.Popen(["xdg-open", path])
+
+def mime_output(payload):
+    """
+        saves a MSG_MIME payload, opening images in the system viewer
+        unless "open_images" is off, returns the text for the output panel
+    """
+    (mimetype, data) = unpack_mime(payload)
+    path = save_mime(mimetype, data)
+    if mimetype.startswith("image/") and settings_snapshot.get("open_images", True):
+        try:
+            open_externally(path)
+        except OSError as err:
+            print "couldn't open %s [%s]" % (path, err)
+    return "%s: %s\n" % (mimetype, path)
+
+# bytes of an execute's output the daemon sends, the rest stays there until
+# fetched with "IPython: Show full output"
+DEFAULT_OUTPUT_LIMIT = {"head": 256 * 1024, "tail": 16 * 1024}
+
+# the most recent outputs the daemon truncated, newest last
+truncated_outputs = []
+
+def format_size(size):
+    if size < 1024 * 1024:
+        return "%.1fKB" % (size / 1024.0)
+    return "%.1fMB" % (size / (1024.0 * 1024))
+
+def truncated_output(payload):
+    """ remembers a MSG_TRUNCATED's handle, returns the text for the output panel """
+    info = loads(payload)
+    truncated_outputs.append(info)
+    del truncated_outputs[:-20]
+    return "\n[... %s of %s omitted, \"IPython: Show full output\" shows it all ...]\n" % (
+        format_size(info["omitted"]), format_size(info["size"]))
+
+class Execution:
+    """
+        an execute handed to the ExecutionEngine, on_output(success, payload)
+        and on_complete(status) are always called on the main thread, status
+        is one of 'success', 'failure', 'timeout' or 'cancelled'. The
+        timeout counts from submission, time spent queued included.
+    """
+    def __init__(self, code, on_output = None, on_complete = None, kernel = None, timeout = 0,
+                 priority = "interactive"):
+        self.code = code
+        self.kernel = kernel
+        self.priority = priority
+        # set by ExecutionEngine.submit_batch
+        self.cells = None
+        self.cell_timeout = 0
+        self.stop_on_error = True
+        self.on_output = on_output
+        self.on_complete = on_complete
+        self.pending = None
+        self.success = True
+        self.timed_out = False
+        self.finished = False
+        self.status = None
+        self.lock = threading.Lock()
+        self.deadline = time.time() + timeout if timeout else None
+        self.watchdog = None
+
+    def remaining(self):
+        """ seconds left before the deadline, None without one """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def watch(self):
+        """ times the execute out if the daemon doesn't say it has by the deadline """
+        if self.deadline is None:
+            return
+        self.watchdog = threading.Timer(self.remaining() + REPLY_GRACE, self.expire,
+                                        ["no reply from the daemon in time"])
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def expire(self, message):
+        """ times out without waiting for the daemon """
+        self.on_frame(MSG_TIMEOUT, message)
+        self.finish('timeout')
+
+    def on_frame(self, msgtype, payload):
+        if msgtype is None:
+            print "execute failed [%s]" % payload
+            self.finish('failure')
+        elif msgtype == MSG_DONE:
+            # a batch also fails when cells were dropped without an error
+            if not loads(payload).get("success", True):
+                self.success = False
+            self.complete()
+        else:
+            if msgtype == MSG_ERROR:
+                self.success = False
+            elif msgtype == MSG_TIMEOUT:
+                # MSG_DONE follows
+                self.success = False
+                self.timed_out = True
+                payload = "\n[%s]\n" % payload
+            elif msgtype == MSG_CELL:
+                payload = "[cell %d/%d]\n" % (loads(payload)["index"] + 1, len(self.cells))
+            elif msgtype == MSG_MIME and not self.finished:
+                payload = mime_output(payload)
+            elif msgtype == MSG_TRUNCATED:
+                payload = truncated_output(payload)
+            if self.on_output is not None and not self.finished:
+                success = msgtype not in (MSG_ERROR, MSG_TIMEOUT)
+                sublime.set_timeout(lambda: self.output(success, payload), 0)
+            if self.pending is not None and self.pending.is_final(msgtype):
+                # a version 1 daemon's only reply, there is no MSG_DONE
+                self.complete()
+
+    def complete(self):
+        if self.timed_out:
+            self.finish('timeout')
+        else:
+            self.finish('success' if self.success else 'failure')
+
+    def output(self, success, payload):
+        # a cancel may have come in while this was waiting for the main
+        # thread, output that arrived before the execute finished still shows
+        if self.status != 'cancelled':
+            self.on_output(success, payload)
+
+    def cancel(self):
+        self.finish('cancelled')
+
+    def interrupt(self):
+        """ interrupt the kernel running this, or cancel it if it hasn't been sent yet """
+        pending = self.pending
+        if pending is None:
+            self.cancel()
+        elif not self.finished:
+            engine.client.daemon.interrupt(pending)
+
+    def finish(self, status):
+        self.lock.acquire()
+        try:
+            if self.finished:
+                return
+            self.finished = True
+            self.status = status
+        finally:
+            self.lock.release()
+
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        engine.discard(self)
+        if self.on_complete is not None:
+            sublime.set_timeout(lambda: self.on_complete(status), 0)
+
+class ExecutionEngine:
+    """
+        sends executes to the daemon from a worker thread, so starting the
+        daemon and waiting on the kernel never holds up the editor. Replies
+        are picked up by the connection's reader thread.
+    """
+    def __init__(self, port = 48721):
+        self.client = Client(port)
+        self.queue = Queue.Queue()
+        self.in_flight = []
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, code, on_output = None, on_complete = None, kernel = None, timeout = None,
+               priority = "interactive"):
+        if timeout is None:
+            timeout = settings_snapshot.get("execute_timeout", 0)
+        return self.enqueue(Execution(code, on_output, on_complete, kernel, timeout, priority))
+
+    def submit_batch(self, cells, on_output = None, on_complete = None, kernel = None, timeout = None,
+                     stop_on_error = True):
+        """
+            runs cells in order with one request, timeout applies to each
+            cell and the cells after one that fails are dropped unless
+            stop_on_error is False
+        """
+        if timeout is None:
+            timeout = settings_snapshot.get("execute_timeout", 0)
+        execution = Execution("\n".join(cells), on_output, on_complete, kernel, priority = "batch")
+        execution.cells = cells
+        execution.cell_timeout = timeout
+        execution.stop_on_error = stop_on_error
+        return self.enqueue(execution)
+
+    def enqueue(self, execution):
+        self.lock.acquire()
+        try:
+            self.in_flight.append(execution)
+            if self.worker is None:
+                self.worker = threading.Thread(target = self.run)
+                self.worker.daemon = True
+                self.worker.start()
+        finally:
+            self.lock.release()
+
+        self.queue.put(execution)
+        return execution
+
+    def run(self):
+        while True:
+            execution = self.queue.get()
+            if execution.finished:
+                continue
+            remaining = execution.remaining()
+            if remaining is not None and remaining <= 0:
+                execution.expire("timed out before it was sent")
+                continue
+            try:
+                if execution.cells is not None:
+                    options = execute_options(execution.kernel, execution.cell_timeout, execution.priority)
+                    options['stop_on_error'] = execution.stop_on_error
+                    pending = self.client.daemon.request(MSG_BATCH, dumps(execution.cells), FLAG_STREAM,
+                                                         options)
+                else:
+                    pending = self.client.daemon.request(MSG_EXECUTE, str(execution.code), FLAG_STREAM,
+                                                         execute_options(execution.kernel, remaining,
+                                                                         execution.priority))
+            except Exception as err:
+                execution.on_frame(None, err)
+                continue
+            execution.pending = pending
+            execution.watch()
+            pending.listen(execution.on_frame)
+
+    def discard(self, execution):
+        self.lock.acquire()
+        try:
+            if execution in self.in_flight:
+                self.in_flight.remove(execution)
+        finally:
+            self.lock.release()
+
+    def running(self):
+        self.lock.acquire()
+        try:
+            return len(self.in_flight)
+        finally:
+            self.lock.release()
+
+    def interrupt_all(self):
+        self.lock.acquire()
+        try:
+            executions = list(self.in_flight)
+        finally:
+            self.lock.release()
+
+        for execution in executions:
+            execution.interrupt()
+        return len(executions)
+
+    def cancel_all(self):
+        self.lock.acquire()
+        try:
+            executions = list(self.in_flight)
+        finally:
+            self.lock.release()
+
+        for execution in executions:
+            execution.cancel()
+        return len(executions)
+
+engine = ExecutionEngine()
+
+def start_daemon_on_load():
+    """ with the "start_daemon_on_load" setting, have the daemon ready before the first send """
+    snapshot_settings()
+    if not settings_snapshot.get("start_daemon_on_load", False):
+        return
+    def connect():
+        try:
+            engine.client.daemon.connect()
+        except Exception as err:
+            print "couldn't start the ipython daemon [%s]" % err
+    thread = threading.Thread(target = connect)
+    thread.daemon = True
+    thread.start()
+
+sublime.set_timeout(start_daemon_on_load, 0)
+
+# kernel selectors bound with bind_ipython_kernel, keyed by window id
+window_kernels = {}
+
+def parse_kernel_selector(text):
+    """
+        "profile:<name>", a connection file name ending in .json or
+        otherwise a kernel id
+    """
+    text = text.strip()
+    if not text:
+        return None
+    if text.startswith("profile:"):
+        return {"profile": text[len("profile:"):].strip()}
+    if text.endswith(".json"):
+        return {"connection_file": text}
+    return {"kernel_id": text}
+
+def kernel_selector(view):
+    """
+        the kernel to send view's code to, a binding made for its window
+        wins over an "ipython_kernel" view setting (settings in a project
+        file end up there), which wins over the "kernel" setting
+    """
+    window = view.window()
+    if window is not None and window.id() in window_kernels:
+        return window_kernels[window.id()]
+    if view.settings().has("ipython_kernel"):
+        return view.settings().get("ipython_kernel")
+    return load_settings().get("kernel")
+
+class OutputPanel:
+    """
+        a window's "ipython" output panel. Output is queued and inserted at
+        most once every "panel_flush_ms", once the panel grows past
+        "panel_max_chars" or "panel_max_lines" the oldest quarter is erased,
+        and everything is appended to a log file as well.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.view = window.get_output_panel("ipython")
+        self.view.set_syntax_file(os.path.join(plugin_dir(),"ipython_output.tmLanguage"))
+        self.log_path = os.path.join(session_dir(), "output-%d.log" % window.id())
+        self.pending = []
+        self.scheduled = False
+
+    def write(self, text):
+        if not isinstance(text, unicode):
+            text = text.decode("utf-8", "replace")
+        self.pending.append(text)
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.flush, load_settings().get("panel_flush_ms", 50))
+
+    def flush(self):
+        self.scheduled = False
+        if not self.pending:
+            return
+        text = u"".join(self.pending)
+        self.pending = []
+        self.log(text)
+
+        view = self.view
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        view.insert(edit, view.size(), text)
+        self.evict(edit)
+        view.end_edit(edit)
+        view.set_read_only(True)
+
+        view.show(view.size())
+        self.window.run_command("show_panel", {"panel": "output.ipython"})
+
+    def evict(self, edit):
+        settings = load_settings()
+        max_chars = settings.get("panel_max_chars", 1000000)
+        max_lines = settings.get("panel_max_lines", 20000)
+        view = self.view
+        size = view.size()
+        end = 0
+        if max_chars and size > max_chars:
+            end = view.full_line(size - max_chars * 3 / 4).end()
+        if max_lines:
+            lines = view.rowcol(size)[0] + 1
+            if lines > max_lines:
+                end = max(end, view.text_point(lines - max_lines * 3 / 4, 0))
+        if end:
+            view.erase(edit, sublime.Region(0, end))
+            view.insert(edit, 0, "[... earlier output is in %s, see \"IPython: Open output log\" ...]\n"
+                        % self.log_path)
+
+    def log(self, text):
+        try:
+            f = open(self.log_path, "ab")
+            try:
+                f.write(text.encode("utf-8"))
+            finally:
+                f.close()
+        except IOError as err:
+            print "couldn't write %s [%s]" % (self.log_path, err)
+
+# keyed by window id, get_output_panel empties the panel so it is only
+# called once per window
+output_panels = {}
+
+def output_panel(window):
+    if window.id() not in output_panels:
+        output_panels[window.id()] = OutputPanel(window)
+    return output_panels[window.id()]
+
+class SendToIpythonCommand(sublime_plugin.TextCommand):
+ 
+    def run(self, edit):
+        """
+            send the current selection (or whole buffer if no selection)
+            to the ipython process.
+        """ 
+        
+        self.panel = output_panel(self.view.window())
+
+        sel = self.view.sel()
+        if sel[0]:
+            text = '\n'.join(self.view.substr(reg) for reg in sel)
+        else:
+            size = self.view.size()
+            text = self.view.substr(sublime.Region(0, size))
+
+        snapshot_settings()
+        engine.submit(text, on_output = self.on_output, on_complete = self.on_complete,
+                      kernel = kernel_selector(self.view))
+        self.update_status()
+
+    def update_status(self):
+        running = engine.running()
+        if running > 0:
+            self.view.set_status( "ipython", "send to ipython - running (%d)" % running )
+
+    def on_complete(self, status):
+        self.view.set_status( "ipython", "send to ipython - %s" % status )
+        self.update_status()
+ 
+
+    def on_output(self, success, payload):
+        self.panel.write(payload)
+
+# a line starting one of these begins a new cell
+CELL_MARKERS = ("# %%", "##")
+
+def split_cells(text):
+    """ text split into cells at CELL_MARKERS lines, leaving out cells with no code """
+    cells = []
+    lines = []
+    code = False
+    for line in text.splitlines():
+        marker = line.lstrip().startswith(CELL_MARKERS)
+        if marker and lines:
+            if code:
+                cells.append("\n".join(lines))
+            lines = []
+            code = False
+        lines.append(line)
+        code = code or (not marker and bool(line.strip()))
+    if code:
+        cells.append("\n".join(lines))
+    return cells
+
+class SendAllCellsToIpythonCommand(SendToIpythonCommand):
+
+    def run(self, edit):
+        """
+            send the whole buffer a cell at a time, in one batch, stopping at
+            the first cell that fails
+        """
+        self.panel = output_panel(self.view.window())
+        cells = split_cells(self.view.substr(sublime.Region(0, self.view.size())))
+        if not cells:
+            return
+        snapshot_settings()
+        engine.submit_batch(cells, on_output = self.on_output, on_complete = self.on_complete,
+                            kernel = kernel_selector(self.view))
+        self.update_status()
+
+class CancelIpythonCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit):
+        """
+            stop waiting on every execute still in flight, the kernel carries
+            on running them
+        """
+        cancelled = engine.cancel_all()
+        sublime.status_message("cancelled %d ipython execute(s)" % cancelled)
+
+class IpythonInterruptCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit):
+        """
+            interrupt the kernel for every execute in flight, like ctrl-c in
+            an ipython console
+        """
+        try:
+            interrupted = engine.interrupt_all()
+        except Exception as err:
+            sublime.status_message("couldn't interrupt ipython [%s]" % err)
+            return
+        sublime.status_message("interrupted %d ipython execute(s)" % interrupted)
+
+class ShowIpythonStatsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        """ show how long executes wait for each kernel the daemon is connected to """
+        snapshot_settings()
+        thread = threading.Thread(target = self.fetch)
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self):
+        try:
+            stats = engine.client.stats()
+        except Exception as err:
+            message = "couldn't get ipython stats [%s]" % err
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+            return
+        items = []
+        for (connection_file, kernel) in sorted(stats.items()):
+            waits = "no executes yet"
+            if "wait_mean" in kernel:
+                waits = "waited %.3fs mean, %.3fs median, %.3fs max" % (
+                    kernel["wait_mean"], kernel["wait_median"], kernel["wait_max"])
+            items.append([os.path.basename(connection_file),
+                          "%d queued%s, %d at most" % (kernel["queued"],
+                              " + 1 running" if kernel["running"] else "", kernel["max_depth"]),
+                          "%d run, %d coalesced" % (kernel["submitted"], kernel["coalesced"]),
+                          waits])
+        if not items:
+            items = [["no kernels connected"]]
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, None), 0)
+
+class OpenIpythonOutputLogCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        """ open everything the output panel has shown, including what it has dropped """
+        panel = output_panels.get(self.window.id())
+        if panel is None or not os.path.exists(panel.log_path):
+            sublime.status_message("no ipython output yet")
+            return
+        panel.flush()
+        self.window.open_file(panel.log_path)
+
+class BindIpythonKernelCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        """
+            send this window's code to a particular kernel, leave the input
+            empty to go back to the configured kernel
+        """
+        current = window_kernels.get(self.window.id(), {})
+        if "profile" in current:
+            initial = "profile:%s" % current["profile"]
+        else:
+            initial = current.get("connection_file", current.get("kernel_id", ""))
+        self.window.show_input_panel("Kernel id, connection file or profile:<name>",
+                                     initial, self.on_done, None, None)
+
+    def on_done(self, text):
+        selector = parse_kernel_selector(text)
+        if selector is None:
+            window_kernels.pop(self.window.id(), None)
+            sublime.status_message("ipython kernel binding cleared")
+        else:
+            window_kernels[self.window.id()] = selector
+            sublime.status_message("ipython kernel bound to %s" % text.strip())
+
+class ShowIpythonOutputCommand(sublime_plugin.WindowCommand):
+
+    page_size = 1024 * 1024
+
+    def run(self):
+        """
+            fetch the full text of an output the daemon truncated into a
+            new view, a page at a time
+        """
+        if not truncated_outputs:
+            sublime.status_message("no truncated ipython output")
+            return
+        self.outputs = list(reversed(truncated_outputs))
+        if len(self.outputs) == 1:
+            self.on_done(0)
+        else:
+            self.window.show_quick_panel(["output %d, %s" % (info["handle"], format_size(info["size"]))
+                                          for info in self.outputs], self.on_done)
+
+    def on_done(self, index):
+        if index < 0:
+            return
+        info = self.outputs[index]
+        view = self.window.new_file()
+        view.set_scratch(True)
+        view.set_name("IPython output %d" % info["handle"])
+        snapshot_settings()
+        thread = threading.Thread(target = self.fetch, args = (view, info))
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self, view, info):
+        # pages can split a utf-8 sequence
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        try:
+            for offset in range(0, info["size"], self.page_size):
+                page = decoder.decode(engine.client.fetch(info["handle"], offset, self.page_size))
+                sublime.set_timeout(lambda page = page: self.append(view, page), 0)
+        except Exception as err:
+            message = "couldn't fetch ipython output %d [%s]" % (info["handle"], err)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+    def append(self, view, page):
+        edit = view.begin_edit()
+        view.insert(edit, view.size(), page)
+        view.end_edit(edit)
\ No newline at end of file
@@ -1,46 +1,363 @@
 import struct
+import socket
+import threading
 from struct import pack, unpack
+from json import dumps, loads
 
 class SocketDisconnected(RuntimeError): pass
 
+try:
+    memoryview
+except NameError:
+    # python 2.6 (sublime text 2) has no memoryview, reads fall back to
+    # collecting chunks
+    memoryview = None
+
+# compression codecs by name, in order of preference
+CODECS = {}
+CODEC_PREFERENCE = []
+
+try:
+    try:
+        from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+    except ImportError:
+        from lz4 import compress as lz4_compress, decompress as lz4_decompress
+    CODECS['lz4'] = (lz4_compress, lz4_decompress)
+    CODEC_PREFERENCE.append('lz4')
+except ImportError:
+    pass
+
+try:
+    import zlib
+    CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+    CODEC_PREFERENCE.append('zlib')
+except ImportError:
+    pass
+
+# payloads smaller than this aren't worth compressing
+COMPRESS_THRESHOLD = 4096
+
+PROTOCOL_VERSION = 2
+
+# message types
+MSG_EXECUTE = 1
+MSG_OK = 2
+MSG_ERROR = 3
+MSG_HELLO = 16
+
+# streamed execute replies, any number of MSG_STREAM, MSG_RESULT, MSG_MIME
+# and MSG_ERROR frames followed by MSG_DONE
+MSG_STREAM = 4
+MSG_RESULT = 5
+MSG_DONE = 6
+# one representation of a result or display, see pack_mime. Only sent for
+# the types listed in the execute's "mime" option
+MSG_MIME = 7
+# output beyond the execute's "output_limit" head was held back, json
+# {"handle", "size", "omitted"}, followed by the tail as MSG_STREAM
+MSG_TRUNCATED = 8
+# json {"handle", "offset", "length"}, answered with MSG_OK and that slice
+# of the full output or MSG_ERROR once the daemon has dropped it
+MSG_FETCH = 9
+# interrupt the kernel running the execute with the frame's request id,
+# that execute then finishes as usual. Version 2 only, there is no reply
+MSG_INTERRUPT = 10
+# the execute ran past its "timeout" option. A buffered execute gets this
+# instead of MSG_OK with the output so far as the payload, a streamed one
+# gets it before MSG_DONE with a message, its output having been sent
+MSG_TIMEOUT = 11
+# answered with MSG_OK and json scheduler metrics for each connected
+# kernel by connection file, see KernelScheduler.stats in the daemon
+MSG_STATS = 12
+# a json list of cells to run in order, streamed like MSG_EXECUTE with
+# MSG_CELL json {"index"} ahead of each cell's output, if it has any, and
+# MSG_DONE json {"success", "ran"} at the end. Unless the "stop_on_error" option is false
+# the cells after one that fails are dropped. Version 2 only
+MSG_BATCH = 13
+MSG_CELL = 14
+
+# frame flags, version 2 only
+FLAG_STREAM = 0x0001
+# the payload starts with a line of json options, see pack_options
+FLAG_OPTIONS = 0x0002
+# the payload is compressed with the codec agreed in MSG_HELLO
+FLAG_COMPRESSED = 0x0004
+
+# version 1 header: msgtype, length
+LEGACY_HEADER = '<bi'
+LEGACY_HEADER_SIZE = struct.calcsize(LEGACY_HEADER)
+
+# version 2 header: version, msgtype, flags, request id, length
+FRAME_HEADER = '<BBHIQ'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+def pack_options(options, body):
+    """
+        prefixes body with a json options object for a frame flagged
+        FLAG_OPTIONS, dumps escapes newlines so the first one ends it
+    """
+    return dumps(options) + '\n' + body
+
+def unpack_options(flags, payload):
+    """ returns (options, body) """
+    if not flags & FLAG_OPTIONS:
+        return ({}, payload)
+    end = payload.index('\n')
+    return (loads(payload[:end]), payload[end + 1:])
+
+def pack_mime(mimetype, data):
+    """ a MSG_MIME payload, the mime type on a line of its own then the raw bytes """
+    return mimetype + '\n' + data
+
+def unpack_mime(payload):
+    """ returns (mimetype, data) """
+    end = payload.index('\n')
+    return (payload[:end], payload[end + 1:])
+
+def pack_header(version, msgtype, length, request_id = 0, flags = 0):
+    if version >= 2:
+        return pack(FRAME_HEADER, version, msgtype, flags, request_id, length)
+    return pack(LEGACY_HEADER, msgtype, length)
+
+def negotiate_version(payload, codecs = None):
+    """
+        daemon side of MSG_HELLO, returns (version, compression, reply
+        payload). compression is the first of the client's codecs that is
+        also in codecs (defaults to every codec available) or None
+    """
+    hello = loads(payload)
+    version = min(hello['version'], PROTOCOL_VERSION)
+    if codecs is None:
+        codecs = CODEC_PREFERENCE
+    compression = None
+    for codec in hello.get('compression', []):
+        if codec in codecs and codec in CODECS:
+            compression = str(codec)
+            break
+    return (version, compression, dumps({'version': version, 'compression': compression}))
+
+def compress_payload(compression, msg, flags):
+    """ returns (msg, flags), compressed if it is worth it """
+    if compression is None or len(msg) < COMPRESS_THRESHOLD:
+        return (msg, flags)
+    compressed = CODECS[compression][0](msg)
+    if len(compressed) >= len(msg):
+        return (msg, flags)
+    return (compressed, flags | FLAG_COMPRESSED)
+
+def decompress_payload(compression, flags, payload):
+    if not flags & FLAG_COMPRESSED:
+        return payload
+    if compression is None:
+        raise RuntimeError("compressed frame on a connection without compression")
+    return CODECS[compression][1](payload)
+
+class FrameParser:
+    """
+        incremental counterpart of Connection.read_frame for non blocking
+        sockets, feed() it whatever arrived and collect complete frames
+        from frames()
+    """
+
+    def __init__(self):
+        self.version = 1
+        self.compression = None
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def frames(self):
+        """
+            yields (msgtype, request_id, flags, payload), the version can be
+            changed between frames
+        """
+        while True:
+            if self.version >= 2:
+                if len(self.buffer) < FRAME_HEADER_SIZE:
+                    return
+                version, msgtype, flags, request_id, length = unpack(FRAME_HEADER,
+                        str(self.buffer[:FRAME_HEADER_SIZE]))
+                if version != self.version:
+                    raise RuntimeError("unexpected frame version : %d" % version)
+                header_size = FRAME_HEADER_SIZE
+            else:
+                if len(self.buffer) < LEGACY_HEADER_SIZE:
+                    return
+                msgtype, length = unpack(LEGACY_HEADER, str(self.buffer[:LEGACY_HEADER_SIZE]))
+                flags, request_id = 0, 0
+                header_size = LEGACY_HEADER_SIZE
+
+            end = header_size + length
+            if len(self.buffer) < end:
+                return
+            payload = str(self.buffer[header_size:end])
+            del self.buffer[:end]
+            yield (msgtype, request_id, flags, decompress_payload(self.compression, flags, payload))
+
 class Connection:
+    """
+        a framed connection to the daemon. Connections start out speaking
+        version 1 (msgtype, length) and switch to version 2 frames, which
+        carry a request id and flags, once both ends have exchanged a
+        MSG_HELLO. Writes are serialised so several threads can share one
+        connection.
+    """
+
+    # size of the receive buffer, headers and small payloads are served
+    # from it, anything bigger is received straight into its own buffer
+    buffer_size = 64 * 1024
+
+    # payloads at least this big are sent separately from their header
+    # rather than copied onto the end of it
+    gather_threshold = 64 * 1024
 
     def __init__(self, sock, verbose = False):
         self.sock = sock
         self.verbose = verbose
+        self.version = 1
+        self.compression = None
+        self.write_lock = threading.Lock()
+        self.rbuf = bytearray(self.buffer_size)
+        self.rstart = 0
+        self.rend = 0
+        if memoryview is not None:
+            self.rview = memoryview(self.rbuf)
+        try:
+            # header and payload can go out as separate sends
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, AttributeError):
+            pass
 
     def read_bytes(self,toread):
-        result = ''
-        while len(result) < toread:
-            chunk = self.sock.recv(toread)
+        if memoryview is None:
+            return self.read_chunks(toread)
+
+        buffered = self.rend - self.rstart
+        if toread <= buffered:
+            result = self.rview[self.rstart:self.rstart + toread].tobytes()
+            self.rstart += toread
+            return result
+
+        if toread <= len(self.rbuf):
+            # move what is left to the front and fill up behind it
+            self.rview[:buffered] = self.rview[self.rstart:self.rend].tobytes()
+            self.rstart, self.rend = 0, buffered
+            while self.rend < toread:
+                self.rend += self.recv_into(self.rview[self.rend:])
+            self.rstart = toread
+            return self.rview[:toread].tobytes()
+
+        # too big for the buffer, receive directly into the result
+        result = bytearray(toread)
+        view = memoryview(result)
+        view[:buffered] = self.rview[self.rstart:self.rend]
+        self.rstart = self.rend = 0
+        received = buffered
+        while received < toread:
+            received += self.recv_into(view[received:])
+        return str(result)
+
+    def recv_into(self, view):
+        received = self.sock.recv_into(view)
+        if received == 0:
+            raise SocketDisconnected("socket connection broken on read")
+        return received
+
+    def read_chunks(self, toread):
+        chunks = []
+        remaining = toread
+        while remaining > 0:
+            chunk = self.sock.recv(min(remaining, self.buffer_size))
             if chunk == '':
                 raise SocketDisconnected("socket connection broken on read")
-            result = result + chunk
-        return result
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
 
     def send_bytes(self, payload):
-        totalsent = 0
-        while totalsent < len(payload):
-            sent = self.sock.send(payload[totalsent:])
-            if sent == 0:
-                raise SocketDisconnected("socket connection broken on write")
-            totalsent = totalsent + sent
+        self.sock.sendall(payload)
 
-    def read_message(self):
+    def read_frame(self):
+        """
+            returns (msgtype, request_id, flags, payload), version 1 frames
+            always have a request_id and flags of 0
+        """
+        if self.verbose:
+            print "read_frame"
+        if self.version >= 2:
+            version, msgtype, flags, request_id, length = unpack(FRAME_HEADER,
+                    self.read_bytes(FRAME_HEADER_SIZE))
+            if version != self.version:
+                raise RuntimeError("unexpected frame version : %d" % version)
+        else:
+            msgtype,length = unpack(LEGACY_HEADER, self.read_bytes(LEGACY_HEADER_SIZE))
+            flags, request_id = 0, 0
+
+        payload = decompress_payload(self.compression, flags, self.read_bytes(length))
+
+        return (msgtype, request_id, flags, payload)
+
+    def write_frame(self, msgtype, msg, request_id = 0, flags = 0):
         if self.verbose:
-            print "read_message"
-        msgtype,length = unpack('<bi', self.read_bytes(5))
-    
-        payload = self.read_bytes(length)
+            print "write_frame"
+        if self.version >= 2:
+            msg, flags = compress_payload(self.compression, msg, flags)
+        header = pack_header(self.version, msgtype, len(msg), request_id, flags)
+
+        self.write_lock.acquire()
+        try:
+            if len(msg) < self.gather_threshold:
+                self.send_bytes(header + msg)
+            else:
+                self.send_bytes(header)
+                self.send_bytes(msg)
+        finally:
+            self.write_lock.release()
 
+    def read_message(self):
+        (msgtype, request_id, flags, payload) = self.read_frame()
         return (msgtype, payload)
 
     def write_message(self, msgtype, msg ):
-        if self.verbose:
-            print "write_message"
-        payload = pack('<bi', msgtype, len(msg) ) + msg
+        self.write_frame(msgtype, msg)
+
+    def negotiate(self, codecs = None):
+        """
+            client side of the version handshake, returns the agreed
+            version. A version 1 daemon doesn't know MSG_HELLO and drops
+            the connection, in which case SocketDisconnected is raised and
+            the caller should reconnect and carry on with version 1.
+            codecs lists the compression codecs to offer, defaults to every
+            codec available, pass [] to turn compression off.
+        """
+        if codecs is None:
+            codecs = CODEC_PREFERENCE
+        self.write_message(MSG_HELLO, dumps({'version': PROTOCOL_VERSION,
+                                             'compression': codecs}))
+        (msgtype, payload) = self.read_message()
+        if msgtype != MSG_HELLO:
+            raise RuntimeError("unexpected reply to hello : %d" % msgtype)
+        reply = loads(payload)
+        self.version = reply['version']
+        compression = reply.get('compression')
+        if compression is not None:
+            compression = str(compression)
+            if compression not in CODECS:
+                raise RuntimeError("daemon picked unknown codec : %s" % compression)
+        self.compression = compression
+        return self.version
 
-        self.send_bytes(payload)
+    def accept_hello(self, payload, codecs = None):
+        """
+            daemon side of the version handshake, the reply is sent with
+            the old framing and both ends switch afterwards
+        """
+        (version, compression, reply) = negotiate_version(payload, codecs)
+        self.write_message(MSG_HELLO, reply)
+        self.version = version
+        self.compression = compression
+        return version
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+    micro benchmark for protocol.Connection, sends frames of increasing size
+    over a socket pair and reports throughput for the buffered connection
+    against the original read/send implementation. With --compression it
+    reports size and cpu cost of each codec on text and random payloads.
+
+    usage: bench_protocol.py [--max-legacy BYTES] [--repeat N] [--compression]
+"""
+
+import sys
+import os
+import random
+import socket
+import threading
+from os.path import join, dirname, abspath
+from time import time
+from struct import pack
+
+sys.path.append(abspath(join(dirname(__file__),"..","lib")))
+
+from protocol import Connection, SocketDisconnected, CODECS, CODEC_PREFERENCE, COMPRESS_THRESHOLD
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024]
+
+class LegacyConnection(Connection):
+    """
+        the read/send loops protocol.Connection started out with, except
+        that reads are limited to what is left of the frame, the original
+        recv(toread) reads into the next frame when they are back to back
+    """
+
+    def read_bytes(self,toread):
+        result = ''
+        while len(result) < toread:
+            chunk = self.sock.recv(toread - len(result))
+            if chunk == '':
+                raise SocketDisconnected("socket connection broken on read")
+            result = result + chunk
+        return result
+
+    def send_bytes(self, payload):
+        totalsent = 0
+        while totalsent < len(payload):
+            sent = self.sock.send(payload[totalsent:])
+            if sent == 0:
+                raise SocketDisconnected("socket connection broken on write")
+            totalsent = totalsent + sent
+
+    def write_frame(self, msgtype, msg, request_id = 0, flags = 0):
+        self.send_bytes(pack('<bi', msgtype, len(msg)) + msg)
+
+def socket_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+def run(connection_class, size, repeat):
+    client, server = socket_pair()
+    writer = connection_class(client)
+    reader = connection_class(server)
+    payload = 'x' * size
+
+    def send():
+        for i in range(repeat):
+            writer.write_frame(1, payload)
+
+    thread = threading.Thread(target = send)
+    started = time()
+    thread.start()
+    for i in range(repeat):
+        (msgtype, msg) = reader.read_message()
+        assert len(msg) == size
+    elapsed = time() - started
+    thread.join()
+    client.close()
+    server.close()
+    return elapsed
+
+def text_payload(size):
+    """ looks like the repr of a numpy array, which is most large output """
+    generator = random.Random(size)
+    result = []
+    length = 0
+    while length < size:
+        line = "       [%s],\n" % ", ".join(["%11.8f" % generator.gauss(0, 10) for i in range(5)])
+        result.append(line)
+        length += len(line)
+    return ''.join(result)[:size]
+
+def time_codec(codec, payload, repeat):
+    (compress, decompress) = CODECS[codec]
+    started = time()
+    for i in range(repeat):
+        compressed = compress(payload)
+    compress_time = time() - started
+    started = time()
+    for i in range(repeat):
+        decompress(compressed)
+    decompress_time = time() - started
+    return (len(compressed), compress_time, decompress_time)
+
+def compression_table(options):
+    print "threshold %s, codecs %s" % (format_size(COMPRESS_THRESHOLD), ", ".join(CODEC_PREFERENCE) or "none")
+    print "%8s %7s %6s %8s %10s %12s" % ("size", "payload", "codec", "ratio", "comp MB/s", "decomp MB/s")
+    for size in [1024, 4096, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024]:
+        repeat = options.repeat or max(1, min(1000, (16 * 1024 * 1024) // size))
+        total = float(size * repeat) / (1024 * 1024)
+        for (kind, payload) in [("text", text_payload(size)), ("random", os.urandom(size))]:
+            for codec in CODEC_PREFERENCE:
+                (length, compress_time, decompress_time) = time_codec(codec, payload, repeat)
+                print "%8s %7s %6s %8.2f %10.1f %12.1f" % (format_size(size), kind, codec,
+                        float(size) / length, total / compress_time, total / decompress_time)
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return "%d%s" % (size, unit)
+        size /= 1024
+    return "%dGB" % size
+
+def main(options):
+    if options.compression:
+        compression_table(options)
+        return
+    print "%8s %8s %14s %14s" % ("size", "repeat", "buffered MB/s", "legacy MB/s")
+    for size in SIZES:
+        repeat = options.repeat or max(1, min(1000, (64 * 1024 * 1024) // size))
+        total = float(size * repeat) / (1024 * 1024)
+
+        buffered = total / run(Connection, size, repeat)
+        if size <= options.max_legacy:
+            legacy = "%14.1f" % (total / run(LegacyConnection, size, repeat))
+        else:
+            legacy = "%14s" % "skipped"
+        print "%8s %8d %14.1f %s" % (format_size(size), repeat, buffered, legacy)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--max-legacy', dest = 'max_legacy', default = 10 * 1024 * 1024, type = 'int',
+                            help = 'largest payload to run through the legacy reader, it is quadratic')
+    parser.add_option('--repeat', dest = 'repeat', default = 0, type = 'int',
+                            help = 'frames per size, defaults to roughly 64MB worth')
+    parser.add_option('--compression', dest = 'compression', action = 'store_true', default = False,
+                            help = 'report ratio and speed of the compression codecs instead')
+    (options, args) = parser.parse_args()
+    main(options)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+    load benchmark for the daemon, starts it once as a threaded server and
+    once with --event-loop, opens an increasing number of connections that
+    each send executes back to back, and reports latency percentiles,
+    throughput and the daemon's peak thread count and memory (linux only).
+
+    needs a running ipython kernel in the default profile, each execute
+    is sent to it
+
+    usage: bench_server.py [--connections 1,10,50,200] [--requests N] [--code CODE]
+"""
+
+import sys
+import os
+import socket
+import tempfile
+import threading
+import subprocess
+from os.path import join, dirname, abspath, exists
+from time import time, sleep
+
+sys.path.append(abspath(join(dirname(__file__),"..","lib")))
+
+from protocol import Connection, MSG_EXECUTE, MSG_OK
+
+DAEMON = join(dirname(abspath(__file__)), "ipython_send.py")
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_daemon(port, args):
+    ready_file = join(tempfile.gettempdir(), "bench-server-%d.ready" % port)
+    if exists(ready_file):
+        os.remove(ready_file)
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen([sys.executable, DAEMON, "-s", "-p", str(port),
+                                "--ready-file", ready_file] + args,
+                               stdout = devnull, stderr = devnull)
+    deadline = time() + 30
+    while not exists(ready_file):
+        if time() > deadline or process.poll() is not None:
+            raise RuntimeError("daemon did not start")
+        sleep(0.05)
+    return process
+
+def daemon_stats(pid):
+    """ returns (threads, rss in KB) from /proc, or None elsewhere """
+    try:
+        f = open("/proc/%d/status" % pid)
+    except IOError:
+        return None
+    stats = {}
+    for line in f:
+        key, _, value = line.partition(':')
+        stats[key] = value.strip()
+    f.close()
+    return (int(stats['Threads']), int(stats['VmRSS'].split(' ')[0]))
+
+class PeakSampler(threading.Thread):
+    """ samples the daemon's threads and memory while the load runs """
+
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.pid = pid
+        self.peak = None
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            stats = daemon_stats(self.pid)
+            if stats is None:
+                return
+            if self.peak is None:
+                self.peak = stats
+            else:
+                self.peak = (max(self.peak[0], stats[0]), max(self.peak[1], stats[1]))
+            self.done.wait(0.02)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return self.peak or ('-', '-')
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_load(port, connections, requests, code):
+    latencies = []
+    lock = threading.Lock()
+    errors = []
+    barrier = threading.Event()
+
+    def client():
+        try:
+            s = socket.create_connection(("127.0.0.1", port))
+            connection = Connection(s)
+            connection.negotiate()
+            barrier.wait()
+            mine = []
+            for i in range(requests):
+                started = time()
+                connection.write_frame(MSG_EXECUTE, code, i + 1)
+                (msgtype, request_id, flags, payload) = connection.read_frame()
+                mine.append(time() - started)
+                if msgtype != MSG_OK:
+                    errors.append(payload)
+            s.close()
+            with lock:
+                latencies.extend(mine)
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target = client) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    # let every client connect before the clock starts
+    sleep(0.5)
+    started = time()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+    latencies.sort()
+    return latencies, elapsed, errors
+
+def main(options):
+    modes = [("threaded", []), ("event-loop", ["--event-loop"])]
+    print "%-10s %6s %9s %9s %9s %9s %9s %8s %9s" % ("server", "conns", "p50 ms", "p90 ms",
+            "p99 ms", "max ms", "req/s", "threads", "rss KB")
+    print "(threads and rss are peaks while the load runs)"
+    for name, args in modes:
+        port = free_port()
+        process = start_daemon(port, args)
+        try:
+            for connections in [int(c) for c in options.connections.split(',')]:
+                sampler = PeakSampler(process.pid)
+                sampler.start()
+                latencies, elapsed, errors = run_load(port, connections, options.requests, options.code)
+                threads, rss = sampler.stop()
+                if not latencies:
+                    print "%-10s %6d failed : %s" % (name, connections, errors[:1])
+                    continue
+                print "%-10s %6d %9.2f %9.2f %9.2f %9.2f %9.1f %8s %9s" % (name, connections,
+                        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+                        percentile(latencies, 0.99) * 1000, latencies[-1] * 1000,
+                        len(latencies) / elapsed, threads, rss)
+                if errors:
+                    print "  %d errors, first : %s" % (len(errors), errors[0])
+        finally:
+            process.terminate()
+            process.wait()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--connections', dest = 'connections', default = '1,10,50,200',
+                            help = 'comma separated connection counts to run')
+    parser.add_option('--requests', dest = 'requests', default = 20, type = 'int',
+                            help = 'executes sent by each connection')
+    parser.add_option('--code', dest = 'code', default = '1',
+                            help = 'code to execute')
+    (options, args) = parser.parse_args()
+    main(options)
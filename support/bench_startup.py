@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+    startup benchmarks for the daemon.
+
+    By default times closing file descriptors when daemonising at
+    increasing RLIMIT_NOFILE limits with each of the ways lib/daemon can do
+    it. Each run is a forked child with the limit set and a few descriptors
+    open, as the daemon would have. Limits the process isn't allowed to
+    raise to are skipped.
+
+    --imports prints a -X importtime style profile of loading the daemon,
+    IPython included, in a fresh interpreter: microseconds spent in each
+    module itself and with everything it imported.
+
+    --first-response starts the daemon --repeat times each way (binding
+    its own socket or inheriting one with --listen-fd, threaded or
+    --event-loop) and reports the median time until it accepts a
+    connection, answers MSG_HELLO and answers a first execute. Without a
+    running kernel the first execute is answered with an error, which
+    still shows when the daemon is serving.
+
+    usage: bench_startup.py [--limits N,N,...] [--open N]
+           bench_startup.py --imports
+           bench_startup.py --first-response [--repeat N] [--code CODE]
+"""
+
+import sys
+# what the interpreter loaded before this script, see profile_imports()
+STARTUP_MODULES = set(sys.modules)
+import os
+import resource
+import socket
+import subprocess
+import __builtin__
+from os.path import join, dirname, abspath
+from time import time, sleep
+
+sys.path.append(abspath(join(dirname(__file__),"..","lib")))
+
+from daemon import daemon
+from protocol import Connection, MSG_EXECUTE
+
+DAEMON = join(dirname(abspath(__file__)), "ipython_send.py")
+
+LIMITS = [1024, 64 * 1024, 1024 * 1024]
+
+def legacy_close_all_open_files(exclude = set()):
+    """ what close_all_open_files did before it looked at /proc/self/fd """
+    maxfd = daemon.get_maximum_file_descriptors()
+    for fd in reversed(range(maxfd)):
+        if fd not in exclude:
+            daemon.close_file_descriptor_if_open(fd)
+
+def closerange_close_all_open_files(exclude = set()):
+    daemon.close_file_descriptor_ranges(daemon.get_maximum_file_descriptors(), exclude)
+
+STRATEGIES = [
+    ("loop", legacy_close_all_open_files),
+    ("closerange", closerange_close_all_open_files),
+    ("close_all_open_files", daemon.close_all_open_files),
+]
+
+def time_in_child(limit, count, close):
+    """ seconds close() takes in a child with the given limit, None if it can't be set """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        result = "skip"
+        try:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))
+                files = [open(os.devnull) for i in range(count)]
+                started = time()
+                close(exclude = set([write_fd]))
+                result = "%f" % (time() - started)
+            except (ValueError, OSError):
+                pass
+            os.write(write_fd, result)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    if result in ("", "skip"):
+        return None
+    return float(result)
+
+def close_files_table(options):
+    limits = [int(limit) for limit in options.limits.split(",")]
+    print "%d descriptors open, /proc/self/fd %s" % (
+        options.open, "listed" if daemon.get_open_file_descriptors() is not None else "not available")
+    print "%10s" % "limit" + "".join("%22s" % name for (name, close) in STRATEGIES)
+    for limit in limits:
+        row = "%10d" % limit
+        for (name, close) in STRATEGIES:
+            elapsed = time_in_child(limit, options.open, close)
+            row += "%22s" % ("-" if elapsed is None else "%.2fms" % (elapsed * 1000))
+        print row
+
+# import profile
+
+class ImportProfiler(object):
+    """
+        wraps __import__ and records (depth, module, self, cumulative) for
+        every import that loaded something, in the order they finished
+    """
+
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.original = __builtin__.__import__
+
+    def install(self):
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def timed_import(self, name, *args):
+        loaded = len(sys.modules)
+        self.stack.append(0.0)
+        started = time()
+        try:
+            return self.original(name, *args)
+        finally:
+            elapsed = time() - started
+            children = self.stack.pop()
+            if len(sys.modules) > loaded:
+                self.records.append((len(self.stack), name, elapsed - children, elapsed))
+                if self.stack:
+                    self.stack[-1] += elapsed
+
+    def report(self):
+        print "import time: self [us] | cumulative | imported package"
+        for (depth, name, own, cumulative) in self.records:
+            print "import time: %9d | %10d | %s%s" % (own * 1e6, cumulative * 1e6, "  " * depth, name)
+
+def profile_imports():
+    """ runs in a fresh interpreter, see --imports """
+    sys.path.append(dirname(abspath(__file__)))
+    # start from what the daemon itself would start from
+    for name in list(sys.modules):
+        if name not in STARTUP_MODULES:
+            del sys.modules[name]
+    profiler = ImportProfiler()
+    profiler.install()
+    started = time()
+    import ipython_send
+    loaded = time() - started
+    try:
+        ipython_send.kernel_manager_class()
+    except ipython_send.IPythonNotFoundException as e:
+        print e.value
+    total = time() - started
+    profiler.uninstall()
+    profiler.report()
+    print "daemon module %.1fms, with IPython %.1fms" % (loaded * 1000, total * 1000)
+
+# time to first response
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def connect(port, deadline):
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(("127.0.0.1", port))
+            return s
+        except socket.error:
+            s.close()
+            if time() > deadline:
+                raise RuntimeError("daemon did not start")
+            sleep(0.002)
+
+def first_response(args, inherit, code):
+    """ seconds from starting the daemon to (connected, hello answered, execute answered) """
+    port = free_port()
+    cmd = [sys.executable, DAEMON, "-s", "-p", str(port)] + args
+    listener = None
+    if inherit:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", port))
+        listener.listen(16)
+        cmd += ["--listen-fd", str(listener.fileno())]
+    devnull = open(os.devnull, 'w')
+    started = time()
+    process = subprocess.Popen(cmd, stdout = devnull, stderr = devnull)
+    try:
+        if listener is not None:
+            listener.close()
+        connection = Connection(connect(port, started + 30))
+        connected = time() - started
+        connection.negotiate()
+        negotiated = time() - started
+        connection.write_frame(MSG_EXECUTE, code)
+        connection.read_frame()
+        answered = time() - started
+        connection.sock.close()
+    finally:
+        process.terminate()
+        process.wait()
+        devnull.close()
+    return (connected, negotiated, answered)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def first_response_table(options):
+    print "median of %d starts, ms from starting the daemon" % options.repeat
+    print "%-28s %10s %10s %10s" % ("", "connected", "hello", "execute")
+    for (name, args, inherit) in [("bind", [], False),
+                                  ("--listen-fd", [], True),
+                                  ("bind --event-loop", ["--event-loop"], False),
+                                  ("--listen-fd --event-loop", ["--event-loop"], True)]:
+        runs = [first_response(args, inherit, options.code) for i in range(options.repeat)]
+        print "%-28s %10.1f %10.1f %10.1f" % tuple([name] + [median(column) * 1000 for column in zip(*runs)])
+
+def main(options):
+    if options.import_child:
+        profile_imports()
+    elif options.imports:
+        subprocess.call([sys.executable, abspath(__file__), "--import-child"])
+    elif options.first_response:
+        first_response_table(options)
+    else:
+        close_files_table(options)
+
+if __name__ == '__main__':
+    from optparse import OptionParser, SUPPRESS_HELP
+    parser = OptionParser()
+    parser.add_option('--limits', dest = 'limits', default = ",".join(str(limit) for limit in LIMITS),
+                      help = 'comma separated RLIMIT_NOFILE values to try')
+    parser.add_option('--open', dest = 'open', default = 20, type = 'int',
+                      help = 'descriptors to open before closing them all')
+    parser.add_option('--imports', dest = 'imports', action = 'store_true', default = False,
+                      help = 'profile the imports made loading the daemon')
+    parser.add_option('--import-child', dest = 'import_child', action = 'store_true', default = False,
+                      help = SUPPRESS_HELP)
+    parser.add_option('--first-response', dest = 'first_response', action = 'store_true', default = False,
+                      help = 'time from starting the daemon to its first replies')
+    parser.add_option('--repeat', dest = 'repeat', default = 5, type = 'int',
+                      help = 'daemon starts to take the median of')
+    parser.add_option('--code', dest = 'code', default = '1',
+                      help = 'code for the first execute')
+    (options, args) = parser.parse_args()
+    main(options)
@@ -1,281 +1,2467 @@
-#!/usr/bin/env python
-
-import sys
-from os import listdir
-from os.path import expanduser, join, dirname,abspath
-
-sys.path.append(abspath(join(dirname(__file__),"..","lib")))
-print "\n".join(sys.path)
-import logging
-
-from IPython.zmq.blockingkernelmanager import BlockingKernelManager
-
-from json import loads
-
-from threading import Thread
-from datetime import datetime
-from time import sleep
-
-import re
-import socket
-import SocketServer
-
-from protocol import Connection, SocketDisconnected
-
-
-
-verbose = False
-
-class IPythonNotFoundException(Exception):
-    def __init__(self, value):
-        self.value = value
-
-    def __str__(self):
-        return repr(self.value)
-
-# utils
-
-def check_port_open(ip, port):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect((ip, port))
-        s.shutdown(2)
-        status = True
-    except:
-        status = False
-    return status
-
-
-def find_alive_server():
-    # assuming we are using default profile
-    security_dir = expanduser('~/.ipython/profile_default/security')
-    all_json_files = listdir(security_dir)
-    for json_file in all_json_files:
-        with open(join(security_dir, json_file)) as f:
-            cfg = loads(f.read())
-        ip, port = cfg['ip'], cfg['shell_port']
-        if check_port_open(ip, port):
-            return cfg
-
-
-# text processing
-
-def strip_comment_lines(s):
-    comment = re.compile('^#.+')
-    return comment.sub('', s)
-
-
-def strip_color_escapes(s):
-    strip = re.compile('\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
-    return strip.sub('', s)
-
-
-# initialize kernel functions
-
-def km_from_cfg(cfg):
-    km = BlockingKernelManager(**cfg)
-    km.start_channels()
-    km.shell_channel.session.key = km.key
-    km.hb_channel.unpause()
-    return km
-
-
-def initialize_km():
-    cfg = find_alive_server()
-    if not cfg:
-        raise IPythonNotFoundException("cannot find alive server")        
-    return km_from_cfg(cfg)
-
-def extract_traceback(traceback):
-    # strip ANSI color controls
-    strip = re.compile('\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
-    tb = [strip.sub('',t) for t in traceback]
-    if len(tb) == 1:
-        # logging.debug(tb[0])
-        line = -1
-        m = re.search(', line (\d+)', tb[0])
-        if m:
-            line = int(m.group(1))
-        return [('<ipython-input>', line, tb[0])]
-    else:
-        result = []
-        for t in tb[1:-1]:
-            m = re.search(r'^(\S+) in (\S+)', t)
-            filename = m.group(1)
-            m = re.search(r'\--+> (\d+)', t)
-            line_num = int(m.group(1))
-            result.append( (filename, line_num, t))
-        return result
-
-def get_response(km, msg_id):
-    
-    success = False
-    out = []
-    error = None
-    while True:
-        msg = km.sub_channel.get_msg()
-        if verbose:
-            logging.debug("---- msg ----")
-            pretty( msg )
-        if msg['msg_type'] == 'status':
-            if msg['content']['execution_state'] == 'idle':
-                break
-        elif msg['msg_type'] == 'stream':
-            content = msg['content']
-            out.append("{0}: {1}".format(content['name'], content['data']))            
-        elif msg['msg_type'] == 'pyout':            
-            out.append(msg['content']['data']['text/plain'])
-        elif msg['msg_type'] == 'pyerr':            
-            c = msg['content']
-            ename, evalue = c['ename'],c['evalue']
-            traceback = '\n'.join(c['traceback'])
-            error = {
-                "traceback" : extract_traceback(c['traceback']),
-                "error" : '{1}: {2}'.format(traceback, ename, evalue)
-            }
-    return (''.join(out), error)
-
-    # return [m for m in msgs
-            # if m['parent_header']['msg_id'] == msg_id]
-
-
-def execute_code(km, code):
-    code = strip_comment_lines(code)
-    return km.shell_channel.execute(code)
-
-def execute(km, code):
-    msg_id = execute_code(km, code)
-    return get_response(km, msg_id)
-    
-# magic object info
-
-def get_object_info(km, word):
-    msg_id = km.shell_channel.object_info(word)
-    response = get_response(km, msg_id)
-    return response[0]
-
-# http://stackoverflow.com/a/3229493/31480
-def pretty(d, indent=0):
-   for key, value in d.iteritems():
-      logging.info('\t' * indent + str(key))
-      if isinstance(value, dict):
-         pretty(value, indent+1)
-      else:
-         logging.info( '\t' * (indent+1) + str(value))
-
-
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    
-    timeout = 300
-    allow_reuse_address = True   
-
-
-last_request = None
-class IPythonRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        global last_request
-        connection = Connection(self.request, verbose = verbose)
-        try:
-            while 1:
-                (msgtype, msg) = connection.read_message()
-                last_request = datetime.now()
-
-                logging.debug( "[%i] [%s]" % (msgtype, msg))
-                if msgtype == 1:
-                    # execute code                    
-                    km = initialize_km()
-                    out, error = execute(km, msg)
-                    logging.debug( "[complete] [%s] [%s]" % (out, error))
-
-                    if error is None:
-                        connection.write_message( 2, out )
-                    else:
-                        connection.write_message( 3, error['error'] )
-                else:
-                    raise RuntimeError("unknown msgtype : %s" % str(msgtype))
-        except SocketDisconnected:
-            logging.info("Client disconnected")
-
-
-def run_server(options):
-    global last_request
-    last_request = datetime.now()
-
-    server = ThreadedTCPServer(("127.0.0.1", options.port), IPythonRequestHandler)
-    logging.info("Listing on %d" % options.port)
-    if options.server_timeout > 0:
-        thread = Thread(target=server.serve_forever)
-        thread.daemon = True
-        thread.start()
-        while 1:
-            now = datetime.now()
-            delta = now - last_request
-            if delta.seconds > options.server_timeout:
-                logging.warn("Server is timed out. exiting")
-                server.shutdown()
-                sys.exit(0)
-            sleep(1)
-    else:
-        server.serve_forever()
-
-def main(options):
-    
-    logconfig = {'level': logging.DEBUG if options.verbose else logging.INFO }
-
-    if options.logfile is not None:
-        logconfig['filename'] = options.logfile
-    else:
-        logconfig['stream'] = sys.stdout
-
-    logging.basicConfig(**logconfig)
-
-
-    if options.server:
-        run_server(options)
-    else:
-        # print options
-        if options.code is not None:
-            code = options.code
-        else:
-            code = sys.stdin.read()
-
-        verbose = options.verbose
-
-        km = initialize_km()
-        out, error = execute(km, code)
-
-        if len( out ) > 0:
-            print "\n".join(out)    
-        if error is not None:
-            print error['error']
-            sys.exit(1)
-        else:
-            sys.exit(0)
-
-if __name__ == '__main__':
-
-    from optparse import OptionParser
-    parser = OptionParser()
-    parser.add_option('-c', dest = 'code', help = 'Code to send to ipython kernel')
-    parser.add_option('-v', '--verbose', dest = 'verbose', action='store_true', default=False,
-                            help = 'Output verbose debug messages')
-    parser.add_option('-s', '--server', dest = 'server', action='store_true', default=False,
-                            help = 'Ignore -c and become a server listening on a port')
-    parser.add_option('-d', '--daemon', dest = 'daemon', action='store_true', default=False,
-                            help = 'Daemonise the process')
-    parser.add_option('-p', '--port', dest = 'port', default=48721, type='int',
-                            help = 'Ignore -c and become a server listening on a port')
-    parser.add_option('--log', dest = 'logfile', default=None, 
-                            help = 'optional Log file')
-    parser.add_option('--server-timeout', dest = 'server_timeout', default=0,  type='int',
-                            help = 'number of seconds after no requests the processed the server will terminate')
-    (options, args) = parser.parse_args()
-
-    if options.daemon:
-        import daemon
-
-        with daemon.DaemonContext(detach_process = True):
-            main(options)
-
-    else:
-        main(options)
+#!/usr/bin/env python
+
+import sys
+import os
+from os import listdir, rename, remove, environ, makedirs, chmod, kill, getpid, close
+from os.path import exists, getmtime, isabs, basename
+from os.path import expanduser, join, dirname,abspath
+
+sys.path.append(abspath(join(dirname(__file__),"..","lib")))
+import logging
+
+# IPython and zmq take longer to import than the rest of the daemon put
+# together, see kernel_manager_class()
+
+from json import loads, dumps
+
+from threading import Thread, Lock, Timer
+from Queue import Queue, Empty
+from time import time
+
+import re
+import heapq
+import signal
+import stat
+import base64
+import errno
+import select
+import socket
+from collections import deque
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from protocol import Connection, SocketDisconnected, MSG_EXECUTE, MSG_OK, MSG_ERROR, MSG_HELLO, \
+                     MSG_STREAM, MSG_RESULT, MSG_DONE, MSG_MIME, MSG_TRUNCATED, MSG_FETCH, MSG_INTERRUPT, \
+                     MSG_TIMEOUT, MSG_STATS, MSG_BATCH, MSG_CELL, FLAG_STREAM, unpack_options, \
+                     FrameParser, pack_header, negotiate_version, compress_payload, pack_mime
+
+
+
+verbose = False
+# compression codecs the server accepts, None means every one available
+compression_codecs = None
+# (head, tail) bytes of output sent for executes without an "output_limit"
+output_limit = (0, 0)
+# seconds executes without a "timeout" get, 0 for no limit
+execute_timeout = 0
+
+class IPythonNotFoundException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class RequestAbandoned(IPythonNotFoundException):
+    """ raised to whoever waits on a request the daemon stopped waiting for """
+
+# utils
+
+def check_port_open(ip, port, timeout = None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if timeout is not None:
+        s.settimeout(timeout)
+    try:
+        s.connect((ip, port))
+        s.shutdown(2)
+        status = True
+    except:
+        status = False
+    s.close()
+    return status
+
+
+def read_connection_file(connection_file):
+    try:
+        with open(connection_file) as f:
+            return loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+# kernel discovery
+
+class KernelDiscovery(object):
+    """
+        index of the connection files in a security directory keyed by
+        path with their mtime, so only new or changed files are re-read.
+        The index is kept up to date with inotify when pyinotify is
+        available, otherwise by checking mtimes on each refresh. Candidates
+        are probed in parallel and the answer is cached for ttl seconds.
+    """
+
+    probe_timeout = 0.25
+    ttl = 5.0
+
+    def __init__(self, security_dir):
+        self.security_dir = security_dir
+        self.lock = Lock()
+        self.files = {}
+        self.dead = {}
+        self.dir_mtime = None
+        self.dirty = set()
+        self.found = None
+        self.found_at = 0
+        self.notifier = None
+        self.watch()
+
+    def watch(self):
+        if pyinotify is None or not exists(self.security_dir):
+            return
+
+        discovery = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                discovery.invalidate(event.pathname)
+
+        try:
+            manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_DELETE | \
+                   pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_CLOSE_WRITE
+            manager.add_watch(self.security_dir, mask)
+            self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+            self.notifier.daemon = True
+            self.notifier.start()
+            # pick up whatever is there already
+            self.dirty.update(join(self.security_dir, name) for name in listdir(self.security_dir))
+        except Exception:
+            logging.exception("unable to watch %s, falling back to polling" % self.security_dir)
+            self.notifier = None
+
+    def invalidate(self, path):
+        with self.lock:
+            self.dirty.add(path)
+            if self.found is not None and self.found[0] == path:
+                self.found = None
+
+    def refresh(self):
+        # called with the lock held
+        if self.notifier is not None:
+            paths, self.dirty = self.dirty, set()
+        else:
+            try:
+                dir_mtime = getmtime(self.security_dir)
+            except OSError:
+                self.files.clear()
+                return
+            # adding or removing a file changes the directory's mtime,
+            # rewriting one in place only changes its own
+            paths = set(self.files)
+            if dir_mtime != self.dir_mtime:
+                self.dir_mtime = dir_mtime
+                paths.update(join(self.security_dir, name) for name in listdir(self.security_dir))
+
+        for path in paths:
+            try:
+                mtime = getmtime(path)
+            except OSError:
+                self.files.pop(path, None)
+                continue
+            if path in self.files and self.files[path][0] == mtime:
+                continue
+            cfg = read_connection_file(path)
+            if cfg is None:
+                self.files.pop(path, None)
+            else:
+                self.files[path] = (mtime, cfg)
+
+    def find(self, exclude = (), selector = None):
+        """
+            returns (connection_file, cfg) for the newest kernel matching
+            selector whose shell port is open, or (None, None)
+        """
+        with self.lock:
+            now = time()
+            if self.found is not None and now - self.found_at < self.ttl and \
+                    self.found[0] not in exclude and self.found[0] in self.files and \
+                    (selector is None or selector.matches(self.found[0])):
+                return self.found
+
+            self.refresh()
+            candidates = []
+            for path, (mtime, cfg) in self.files.items():
+                if path in exclude or (selector is not None and not selector.matches(path)):
+                    continue
+                # files found dead recently are skipped until they change
+                if self.dead.get(path, (None, 0))[0] == mtime and now - self.dead[path][1] < self.ttl:
+                    continue
+                candidates.append((mtime, path, cfg))
+            candidates.sort(reverse = True)
+
+            alive = probe_ports([(cfg['ip'], cfg['shell_port']) for mtime, path, cfg in candidates],
+                                self.probe_timeout)
+            found = (None, None)
+            for (mtime, path, cfg), is_open in zip(candidates, alive):
+                if is_open:
+                    if found[0] is None:
+                        found = (path, cfg)
+                else:
+                    self.dead[path] = (mtime, now)
+            if found[0] is not None:
+                self.found, self.found_at = found, now
+            return found
+
+def probe_ports(addresses, timeout):
+    """ checks every (ip, port) at once, returns a list of booleans """
+    results = [False] * len(addresses)
+    def probe(i, ip, port):
+        results[i] = check_port_open(ip, port, timeout)
+
+    threads = [Thread(target = probe, args = (i, ip, port)) for i, (ip, port) in enumerate(addresses)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(timeout * 2)
+    return results
+
+class KernelSelector(object):
+    """
+        picks kernels by ipython profile, connection file (a name in the
+        profile's security directory or an absolute path) or kernel id, the
+        id being the part of the connection file name after "kernel-".
+        Anything left unset matches any kernel in the default profile.
+    """
+
+    def __init__(self, profile = None, connection_file = None, kernel_id = None):
+        self.profile = profile
+        self.connection_file = connection_file
+        self.kernel_id = kernel_id
+
+    @classmethod
+    def from_options(cls, options):
+        if not options:
+            return cls()
+        return cls(options.get('profile'), options.get('connection_file'), options.get('kernel_id'))
+
+    def security_dir(self):
+        if self.connection_file is not None and isabs(self.connection_file):
+            return dirname(self.connection_file)
+        ipython_dir = environ.get('IPYTHONDIR', '~/.ipython')
+        return expanduser(join(ipython_dir, 'profile_%s' % (self.profile or 'default'), 'security'))
+
+    def matches(self, connection_file):
+        if dirname(connection_file) != self.security_dir():
+            return False
+        name = basename(connection_file)
+        if self.connection_file is not None and name != basename(self.connection_file):
+            return False
+        if self.kernel_id is not None and name != 'kernel-%s.json' % self.kernel_id:
+            return False
+        return True
+
+    def __str__(self):
+        return "profile=%s connection_file=%s kernel_id=%s" % (
+                self.profile or 'default', self.connection_file, self.kernel_id)
+
+discoveries = {}
+discovery_lock = Lock()
+
+def find_alive_server(exclude = (), selector = None):
+    """
+        returns (connection_file, cfg) for a kernel matching selector whose
+        shell port is open, or (None, None)
+    """
+    if selector is None:
+        selector = KernelSelector()
+    security_dir = selector.security_dir()
+    # created on first use so inotify's thread starts after daemonising
+    with discovery_lock:
+        if security_dir not in discoveries:
+            discoveries[security_dir] = KernelDiscovery(security_dir)
+        discovery = discoveries[security_dir]
+    return discovery.find(exclude, selector)
+
+
+# text processing
+
+def strip_comment_lines(s):
+    comment = re.compile('^#.+')
+    return comment.sub('', s)
+
+
+def strip_color_escapes(s):
+    strip = re.compile('\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
+    return strip.sub('', s)
+
+
+# initialize kernel functions
+
+def kernel_manager_class():
+    """
+        IPython's BlockingKernelManager, imported on first use so the
+        server is listening before the import rather than after it. Once it
+        is, the server imports it in the background with
+        preload_kernel_manager().
+    """
+    try:
+        from IPython.zmq.blockingkernelmanager import BlockingKernelManager
+    except ImportError as e:
+        raise IPythonNotFoundException("couldn't import IPython : %s" % e)
+    return BlockingKernelManager
+
+def preload_kernel_manager():
+    def preload():
+        started = time()
+        try:
+            kernel_manager_class()
+        except IPythonNotFoundException as e:
+            logging.error(e.value)
+            return
+        logging.debug("imported IPython in %.3fs" % (time() - started))
+    thread = Thread(target = preload)
+    thread.daemon = True
+    thread.start()
+
+def km_from_cfg(cfg):
+    km = kernel_manager_class()(**cfg)
+    km.start_channels()
+    km.shell_channel.session.key = km.key
+    km.hb_channel.unpause()
+    return km
+
+
+# kernel pool
+
+class KernelRequest(object):
+    """
+        the IOPub messages belonging to one request, get_msg and get_msgs
+        mirror the sub channel's own methods
+    """
+
+    # seconds an interrupted request has to finish before it is abandoned
+    interrupt_grace = 5.0
+
+    def __init__(self, msg_id):
+        self.msg_id = msg_id
+        self.kernel = None
+        self.queue = Queue()
+        self.deadline = None
+        self.timeout = None
+        self.timeout_policy = 'abandon'
+        self.timed_out = False
+        self.abandoned = False
+        self.priority = PRIORITIES['normal']
+        self.submitted_at = None
+        self.started_at = None
+        # coalescing, see KernelScheduler. history holds the messages so
+        # far while others may still follow this request
+        self.lock = Lock()
+        self.history = None
+        self.leader = None
+        self.followers = []
+        # the Batch this is a cell of
+        self.batch = None
+
+    def configure(self, options):
+        """ applies an execute's "timeout", "on_timeout", "priority" and "coalesce" options """
+        self.set_deadline(options.get('timeout', execute_timeout), options.get('on_timeout', 'abandon'))
+        self.priority = request_priority(options.get('priority'))
+        if options.get('coalesce'):
+            self.history = []
+
+    def set_deadline(self, timeout, policy = 'abandon'):
+        """
+            once timeout seconds have passed the kernel is interrupted or,
+            for the 'abandon' policy, left to it, see time_out()
+        """
+        if not timeout:
+            return
+        self.timeout = timeout
+        self.deadline = time() + timeout
+        self.timeout_policy = policy
+
+    def time_out(self):
+        self.timed_out = True
+        if self.timeout_policy == 'interrupt':
+            try:
+                # abandoned after interrupt_grace if it doesn't stop
+                self.interrupt()
+                return
+            except (IPythonNotFoundException, OSError):
+                logging.exception("couldn't interrupt timed out request %s" % self.msg_id)
+        self.abandon("timed out after %.3gs" % self.timeout)
+
+    def put(self, msg):
+        self.queue.put(msg)
+
+    def deliver(self, msg):
+        """ put() from the kernel's side, followers get a copy """
+        if self.batch is not None and isinstance(msg, dict) and msg['msg_type'] == 'pyerr':
+            # before the kernel goes idle and the scheduler starts the next cell
+            self.batch.failed(self)
+        with self.lock:
+            if self.history is not None:
+                if time() - self.submitted_at > KernelScheduler.coalesce_window:
+                    self.history = None
+                else:
+                    self.history.append(msg)
+            followers = list(self.followers)
+        self.put(msg)
+        for follower in followers:
+            follower.put(msg)
+
+    def follow(self, leader):
+        """ gets leader's messages from now on and those it had so far, False if it is too late """
+        with leader.lock:
+            if leader.history is None or time() - leader.submitted_at > KernelScheduler.coalesce_window:
+                return False
+            for msg in leader.history:
+                self.put(msg)
+            leader.followers.append(self)
+        self.leader = leader
+        self.kernel = leader.kernel
+        return True
+
+    def wait(self):
+        while self.deadline is not None and not self.timed_out:
+            remaining = self.deadline - time()
+            if remaining <= 0:
+                self.time_out()
+                break
+            try:
+                return self.queue.get(timeout = remaining)
+            except Empty:
+                pass
+        return self.queue.get()
+
+    def get_msg(self):
+        msg = self.wait()
+        if msg is None:
+            # the kernel was closed while we were waiting on it
+            self.queue.put(None)
+            raise IPythonNotFoundException("lost connection to kernel")
+        if isinstance(msg, Exception):
+            self.queue.put(msg)
+            raise msg
+        return msg
+
+    def get_msgs(self):
+        msgs = []
+        while True:
+            try:
+                msg = self.queue.get_nowait()
+            except Empty:
+                return msgs
+            if msg is None or isinstance(msg, Exception):
+                self.queue.put(msg)
+                return msgs
+            msgs.append(msg)
+
+    def interrupt(self):
+        """
+            interrupts the kernel, which runs one execute at a time so this
+            stops whatever it is running. A request that hasn't finished
+            interrupt_grace seconds later is abandoned, one still queued
+            is dropped from the queue. A follower is only abandoned, the
+            execute it shares is its leader's to interrupt, and so is one
+            whose kernel can't be interrupted.
+        """
+        if self.kernel is None:
+            raise IPythonNotFoundException("the request hasn't reached a kernel yet")
+        if self.leader is not None:
+            self.abandon("interrupted, the execute it shared carries on")
+            return
+        if self.kernel.scheduler.cancel(self):
+            self.abandoned = True
+            self.deliver(RequestAbandoned("interrupted before it ran"))
+            return
+        if not self.kernel.scheduler.is_running(self):
+            # finished already, the kernel may be running someone else's
+            self.abandon("interrupted")
+            return
+        try:
+            self.kernel.interrupt()
+        except (IPythonNotFoundException, OSError) as e:
+            logging.warning("couldn't interrupt the kernel for request %s : %s" % (self.msg_id, e))
+            # it is left running, as for the abandon policy
+            self.timeout_policy = 'abandon'
+            self.abandon("the kernel can't be interrupted, stopped waiting on it : %s" %
+                         getattr(e, 'value', e))
+            return
+        timer = Timer(self.interrupt_grace, self.abandon, ["the kernel didn't stop when interrupted"])
+        timer.daemon = True
+        timer.start()
+
+    def abandon(self, reason):
+        """ stops waiting on the kernel, get_msg raises RequestAbandoned """
+        if self.leader is not None:
+            with self.leader.lock:
+                if self in self.leader.followers:
+                    self.leader.followers.remove(self)
+                    self.abandoned = True
+                    self.put(RequestAbandoned(reason))
+        elif self.kernel is None:
+            # the event loop is still finding it a kernel
+            self.abandoned = True
+            self.deliver(RequestAbandoned(reason))
+        elif self.kernel.scheduler.cancel(self) or self.kernel.forget(self.msg_id) is self:
+            self.abandoned = True
+            self.deliver(RequestAbandoned(reason))
+
+class Batch(object):
+    """
+        the cells of a MSG_BATCH, one KernelRequest each. They are all
+        queued with the kernel's scheduler up front so each goes to the
+        kernel as soon as the one before is done rather than after a round
+        trip to the client. Once a cell fails (with stop_on_error), times
+        out or the batch is interrupted the cells still queued are dropped.
+    """
+
+    def __init__(self, kernel, requests, stop_on_error = True):
+        self.kernel = kernel
+        self.requests = requests
+        self.stop_on_error = stop_on_error
+        self.stopped = False
+        self.cancelled = set()
+        self.lock = Lock()
+        for request in requests:
+            request.batch = self
+            # a follower isn't queued and so couldn't be dropped
+            request.history = None
+
+    def submit(self, cells):
+        with self.lock:
+            for (code, request) in zip(cells, self.requests):
+                if self.stopped:
+                    break
+                self.kernel.execute(code, request)
+
+    def failed(self, request):
+        if self.stop_on_error:
+            self.stop()
+
+    def stop(self):
+        """ drops the cells that haven't started """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            for request in self.requests:
+                if request.submitted_at is None or self.kernel.scheduler.cancel(request):
+                    self.cancelled.add(request)
+        for request in self.requests:
+            if request in self.cancelled:
+                request.deliver(RequestAbandoned("an earlier cell stopped the batch"))
+
+    def is_cancelled(self, request):
+        with self.lock:
+            return request in self.cancelled
+
+    def interrupt(self):
+        """ stops the batch and interrupts the cell running, if any """
+        self.stop()
+        running = self.kernel.scheduler.running
+        if running in self.requests:
+            running.interrupt()
+
+# execute "priority" names, lower runs first
+PRIORITIES = {'interactive': 0, 'normal': 5, 'batch': 10}
+
+def request_priority(priority):
+    if isinstance(priority, (int, long)):
+        return priority
+    return PRIORITIES.get(priority, PRIORITIES['normal'])
+
+class KernelScheduler(object):
+    """
+        runs a kernel's executes one at a time, the rest wait in priority
+        order and first come first served within a priority. An execute
+        with the "coalesce" option that repeats the code of the one
+        submitted just before it, within coalesce_window seconds, doesn't
+        run again but follows the earlier one's messages.
+    """
+
+    coalesce_window = 1.0
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.lock = Lock()
+        self.queue = []
+        self.sequence = 0
+        self.running = None
+        self.last = None
+        # metrics for stats()
+        self.submitted = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen = 100)
+
+    def submit(self, code, request):
+        request.kernel = self.kernel
+        with self.lock:
+            if request.history is not None and self.last is not None:
+                (last_code, leader) = self.last
+                if last_code == code and request.follow(leader):
+                    logging.debug("coalesced a repeat of request %s" % leader.msg_id)
+                    self.coalesced += 1
+                    return request
+            self.last = (code, request)
+            request.submitted_at = time()
+            heapq.heappush(self.queue, (request.priority, self.sequence, request, code))
+            self.sequence += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            start = self.next()
+        if start is not None:
+            self.start(*start)
+        return request
+
+    def next(self):
+        # called with the lock held, the request to start if the kernel is free
+        if self.running is not None or not self.queue:
+            return None
+        (priority, sequence, request, code) = heapq.heappop(self.queue)
+        self.running = request
+        request.started_at = time()
+        self.waits.append(request.started_at - request.submitted_at)
+        logging.debug("starting a priority %d execute after %.3fs, %d more queued" % (
+            priority, request.started_at - request.submitted_at, len(self.queue)))
+        return (request, code)
+
+    def start(self, request, code):
+        try:
+            self.kernel.track(lambda: execute_code(self.kernel.km, code), request)
+        except Exception as e:
+            logging.exception("couldn't send an execute")
+            request.deliver(RequestAbandoned("couldn't send to the kernel : %s" % e))
+            self.finished(request)
+
+    def finished(self, request):
+        """ the running request is done, start the next """
+        with self.lock:
+            if self.running is not request:
+                return
+            self.running = None
+            start = self.next()
+        if start is not None:
+            self.start(*start)
+
+    def is_running(self, request):
+        with self.lock:
+            return self.running is request
+
+    def cancel(self, request):
+        """ takes request out of the queue, False if it isn't queued """
+        with self.lock:
+            for (i, entry) in enumerate(self.queue):
+                if entry[2] is request:
+                    del self.queue[i]
+                    heapq.heapify(self.queue)
+                    return True
+        return False
+
+    def drain(self):
+        """ empties the queue, returns the requests that were in it """
+        with self.lock:
+            requests = [entry[2] for entry in self.queue]
+            self.queue = []
+        return requests
+
+    def stats(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = {
+                'queued': len(self.queue),
+                'running': self.running is not None,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'max_depth': self.max_depth,
+            }
+        if waits:
+            stats['wait_mean'] = sum(waits) / len(waits)
+            stats['wait_median'] = waits[len(waits) // 2]
+            stats['wait_max'] = waits[-1]
+        return stats
+
+
+def process_args(pid):
+    """ pid's command line from /proc, None if it can't be read """
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return f.read().split('\0')[:-1]
+    except (IOError, OSError, ValueError):
+        return None
+
+def started_with(args, name):
+    """ whether a kernel's command line gives it connection file name (-f or connection_file=) """
+    for (i, arg) in enumerate(args):
+        if arg in ('-f', '--f') and i + 1 < len(args):
+            path = args[i + 1]
+        elif arg.startswith('--f=') or arg.startswith('-f=') or '.connection_file=' in arg:
+            path = arg.split('=', 1)[1]
+        else:
+            continue
+        if basename(path.strip('"\'')) == name:
+            return True
+    return False
+
+def kernel_pid(connection_file):
+    """
+        the pid of the kernel connection_file is for, or None. A kernel-<N>.json
+        name can be the pid of the frontend that started the kernel, or of
+        something else by now, so only a process /proc shows is the kernel
+        counts: one started with the file, or an "ipython kernel" that named
+        the file after itself
+    """
+    name = basename(connection_file)
+    match = re.match(r'kernel-(\d+)\.json$', name)
+    if match is not None:
+        pid = int(match.group(1))
+        args = process_args(pid)
+        if args is not None and (started_with(args, name) or 'kernel' in args[1:]):
+            return pid
+    try:
+        pids = [int(entry) for entry in listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        args = process_args(pid)
+        if pid != getpid() and args is not None and started_with(args, name):
+            return pid
+    return None
+
+class PooledKernel(object):
+    """
+        a connected kernel manager kept alive between requests. Executes
+        go through its KernelScheduler. A dispatcher thread reads the IOPub
+        channel and routes each message by its parent msg_id to the
+        KernelRequest waiting on it, so any number of requests can be in
+        flight on one kernel.
+    """
+
+    # the heartbeat channel needs a moment to report a first beat
+    startup_grace = 3.0
+
+    def __init__(self, connection_file, cfg):
+        self.connection_file = connection_file
+        self.cfg = cfg
+        self.km = km_from_cfg(cfg)
+        self.connected_at = time()
+        self.closed = False
+        self.requests = {}
+        self.requests_lock = Lock()
+        self.scheduler = KernelScheduler(self)
+        self.dispatcher = Thread(target = self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def is_alive(self):
+        if time() - self.connected_at < self.startup_grace:
+            return True
+        return self.km.hb_channel.is_beating()
+
+    def track(self, send, request = None):
+        """
+            calls send(), which sends a message on the shell channel and
+            returns its msg_id, and returns the KernelRequest (a new one
+            unless given) its IOPub messages will be routed to
+        """
+        # hold the lock until the request is registered so the dispatcher
+        # can't see a reply before we know about it
+        with self.requests_lock:
+            msg_id = send()
+            if request is None:
+                request = KernelRequest(msg_id)
+            request.msg_id = msg_id
+            request.kernel = self
+            self.requests[msg_id] = request
+        return request
+
+    def execute(self, code, request = None):
+        """ queues code with the scheduler, returns the KernelRequest (a new one unless given) """
+        if request is None:
+            request = KernelRequest(None)
+        return self.scheduler.submit(code, request)
+
+    def forget(self, msg_id):
+        """ stops routing messages for msg_id, returns its request if it was still waiting """
+        with self.requests_lock:
+            request = self.requests.pop(msg_id, None)
+        if request is not None:
+            self.scheduler.finished(request)
+        return request
+
+    def interrupt(self):
+        """ SIGINT for the kernel, through its manager if the manager started it """
+        if self.km.has_kernel:
+            self.km.interrupt_kernel()
+            return
+        pid = None
+        if hasattr(signal, 'SIGINT') and sys.platform != 'win32':
+            pid = kernel_pid(self.connection_file)
+        if pid is None:
+            raise IPythonNotFoundException("can't find the process of the kernel for %s" % self.connection_file)
+        kill(pid, signal.SIGINT)
+
+    def dispatch(self):
+        while not self.closed:
+            try:
+                msg = self.km.sub_channel.get_msg(timeout = 1)
+            except Empty:
+                continue
+
+            msg_id = msg['parent_header'].get('msg_id')
+            finished = msg['msg_type'] == 'status' and \
+                       msg['content']['execution_state'] == 'idle'
+            with self.requests_lock:
+                if finished:
+                    request = self.requests.pop(msg_id, None)
+                else:
+                    request = self.requests.get(msg_id)
+
+            if request is not None:
+                request.deliver(msg)
+                if finished:
+                    self.scheduler.finished(request)
+            elif verbose:
+                logging.debug("dropping %s for unknown request %s" % (msg['msg_type'], msg_id))
+
+    def close(self):
+        self.closed = True
+        with self.requests_lock:
+            requests, self.requests = self.requests.values(), {}
+        for request in requests + self.scheduler.drain():
+            request.deliver(None)
+        try:
+            self.km.stop_channels()
+        except Exception:
+            logging.exception("error stopping channels for %s" % self.connection_file)
+
+
+class KernelPool(object):
+    """
+        long lived, thread safe pool of connected kernels keyed by
+        connection file. Dead kernels (no heartbeat) are reconnected when
+        their connection file still points at an open port and evicted
+        otherwise. Once closing it turns new requests away.
+    """
+
+    def __init__(self):
+        self._kernels = {}
+        self._lock = Lock()
+        self.closing = False
+
+    def get(self, selector = None):
+        if selector is None:
+            selector = KernelSelector()
+        if self.closing:
+            raise IPythonNotFoundException("the daemon is shutting down")
+        # waits out preload_kernel_manager(), the port probes would
+        # otherwise stall behind the import lock it holds and give up
+        kernel_manager_class()
+        with self._lock:
+            for connection_file in list(self._kernels.keys()):
+                if not selector.matches(connection_file):
+                    continue
+                kernel = self._kernels[connection_file]
+                if kernel.is_alive():
+                    return kernel
+                kernel = self._reconnect(kernel)
+                if kernel is not None:
+                    return kernel
+
+            connection_file, cfg = find_alive_server(exclude = self._kernels, selector = selector)
+            if not cfg:
+                raise IPythonNotFoundException("cannot find alive server (%s)" % selector)
+            return self._connect(connection_file, cfg)
+
+    def connected(self, selector = None):
+        """ the kernel get() would return if that needs no probing or connecting, else None """
+        if selector is None:
+            selector = KernelSelector()
+        if self.closing:
+            return None
+        with self._lock:
+            for connection_file in list(self._kernels.keys()):
+                if selector.matches(connection_file):
+                    kernel = self._kernels[connection_file]
+                    return kernel if kernel.is_alive() else None
+        return None
+
+    def _connect(self, connection_file, cfg):
+        logging.info("connecting to kernel %s" % connection_file)
+        kernel = PooledKernel(connection_file, cfg)
+        self._kernels[connection_file] = kernel
+        return kernel
+
+    def _reconnect(self, kernel):
+        logging.warn("kernel %s has no heartbeat" % kernel.connection_file)
+        self.evict(kernel.connection_file, locked = True)
+        cfg = read_connection_file(kernel.connection_file)
+        if cfg is not None and check_port_open(cfg['ip'], cfg['shell_port']):
+            return self._connect(kernel.connection_file, cfg)
+        return None
+
+    def evict(self, connection_file, locked = False):
+        if not locked:
+            with self._lock:
+                return self.evict(connection_file, locked = True)
+        kernel = self._kernels.pop(connection_file, None)
+        if kernel is not None:
+            logging.info("evicting kernel %s" % connection_file)
+            kernel.close()
+
+    def stats(self):
+        """ the scheduler metrics of each kernel by connection file, for MSG_STATS """
+        with self._lock:
+            kernels = list(self._kernels.values())
+        return dict((kernel.connection_file, kernel.scheduler.stats()) for kernel in kernels)
+
+    def close(self):
+        with self._lock:
+            for connection_file in list(self._kernels.keys()):
+                self.evict(connection_file, locked = True)
+
+kernel_pool = KernelPool()
+
+def extract_traceback(traceback):
+    # strip ANSI color controls
+    strip = re.compile('\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
+    tb = [strip.sub('',t) for t in traceback]
+    if len(tb) == 1:
+        # logging.debug(tb[0])
+        line = -1
+        m = re.search(', line (\d+)', tb[0])
+        if m:
+            line = int(m.group(1))
+        return [('<ipython-input>', line, tb[0])]
+    else:
+        result = []
+        for t in tb[1:-1]:
+            m = re.search(r'^(\S+) in (\S+)', t)
+            filename = m.group(1)
+            m = re.search(r'\--+> (\d+)', t)
+            line_num = int(m.group(1))
+            result.append( (filename, line_num, t))
+        return result
+
+def response_event(msg):
+    """
+        turns an IOPub message into ('stream', text), ('result', bundle),
+        ('display', bundle), ('error', error) or ('idle', None), or None if
+        it isn't of interest. A bundle maps mime types to representations.
+    """
+    if verbose:
+        logging.debug("---- msg ----")
+        pretty( msg )
+    if msg['msg_type'] == 'stream':
+        content = msg['content']
+        return ('stream', u"{0}: {1}".format(content['name'], content['data']))
+    elif msg['msg_type'] == 'status':
+        if msg['content']['execution_state'] == 'idle':
+            return ('idle', None)
+    elif msg['msg_type'] == 'pyout':            
+        return ('result', msg['content']['data'])
+    elif msg['msg_type'] == 'display_data':
+        return ('display', msg['content']['data'])
+    elif msg['msg_type'] == 'pyerr':            
+        c = msg['content']
+        ename, evalue = c['ename'],c['evalue']
+        traceback = '\n'.join(c['traceback'])
+        return ('error', {
+            "traceback" : extract_traceback(c['traceback']),
+            "error" : '{1}: {2}'.format(traceback, ename, evalue)
+        })
+    return None
+
+def iter_response(request):
+    """
+        yields ('stream', text), ('result', bundle), ('display', bundle)
+        and ('error', error) as
+        the request's messages arrive until the kernel goes idle. Stream
+        messages that queued up while the caller was busy are merged.
+    """
+    while True:
+        msgs = [request.get_msg()] + request.get_msgs()
+        stream = []
+        for msg in msgs:
+            event = response_event(msg)
+            if event is None:
+                continue
+            if event[0] == 'stream':
+                stream.append(event[1])
+                continue
+
+            if stream:
+                yield ('stream', ''.join(stream))
+                stream = []
+
+            if event[0] == 'idle':
+                return
+            yield event
+        if stream:
+            yield ('stream', ''.join(stream))
+
+def get_response(request, capture = None):
+    """
+        returns (output, error), with a capture only the output within its
+        limit is collected, see OutputCapture.note(). A request that timed
+        out returns what it had so far, check request.timed_out.
+    """
+    out = []
+    error = None
+    try:
+        for (kind, data) in iter_response(request):
+            if kind == 'stream':
+                pass
+            elif kind == 'result':
+                data = data.get('text/plain', '')
+            else:
+                if kind == 'error':
+                    error = data
+                continue
+            if capture is not None:
+                data = capture.feed(data)
+            out.append(data)
+    except RequestAbandoned:
+        if not request.timed_out:
+            raise
+    return (''.join(out), error)
+
+# representations that can be asked for with the "mime" execute option,
+# images are sent as raw bytes rather than the base64 the kernel uses
+MIME_TYPES = ['text/plain', 'text/html', 'image/png', 'application/json']
+BINARY_MIME_TYPES = ['image/png']
+
+def mime_frames(kind, bundle, mimetypes = None):
+    """
+        the frames to send for a result or display bundle. Without
+        mimetypes (the client didn't pass "mime") only a result's
+        text/plain goes back as MSG_RESULT, otherwise every listed type the
+        bundle has does, text/plain still as MSG_RESULT and the rest as
+        MSG_MIME.
+    """
+    if mimetypes is None:
+        if kind == 'result' and 'text/plain' in bundle:
+            return [(MSG_RESULT, bundle['text/plain'])]
+        return []
+
+    frames = []
+    for mimetype in mimetypes:
+        if mimetype not in bundle or mimetype not in MIME_TYPES:
+            continue
+        data = bundle[mimetype]
+        if mimetype == 'text/plain':
+            frames.append((MSG_RESULT, data))
+            continue
+        if mimetype in BINARY_MIME_TYPES:
+            data = base64.b64decode(data)
+        elif not isinstance(data, basestring):
+            data = dumps(data)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        frames.append((MSG_MIME, pack_mime(str(mimetype), data)))
+    return frames
+
+
+class OutputStore(object):
+    """
+        the full output of truncated executes by handle, for MSG_FETCH.
+        Each is a spooled file so anything over spool_size is on disk
+        rather than in memory, the least recently read beyond max_entries
+        are dropped.
+    """
+
+    def __init__(self, max_entries = 32, spool_size = 1024 * 1024):
+        self.max_entries = max_entries
+        self.spool_size = spool_size
+        self.entries = {}
+        self.order = []
+        self.next_handle = 1
+        self.lock = Lock()
+
+    def spool(self):
+        from tempfile import SpooledTemporaryFile
+        return SpooledTemporaryFile(max_size = self.spool_size)
+
+    def add(self, spool):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.entries[handle] = spool
+            self.order.append(handle)
+            while len(self.order) > self.max_entries:
+                self.entries.pop(self.order.pop(0)).close()
+        return handle
+
+    def read(self, handle, offset = 0, length = -1):
+        """ returns a slice of the output or None if it has been dropped """
+        with self.lock:
+            spool = self.entries.get(handle)
+            if spool is None:
+                return None
+            self.order.remove(handle)
+            self.order.append(handle)
+            spool.seek(offset)
+            return spool.read(length)
+
+output_store = OutputStore()
+
+def utf8_boundary(text, index):
+    """ moves index back to the start of the utf-8 sequence it is in """
+    while 0 < index < len(text) and ord(text[index]) & 0xC0 == 0x80:
+        index -= 1
+    return index
+
+class OutputCapture(object):
+    """
+        enforces an execute's output limit. feed() passes through the first
+        head bytes of text output, everything after is spooled into the
+        output_store and only the last tail bytes are kept for finish().
+        A head of 0 means no limit.
+    """
+
+    def __init__(self, head = 0, tail = 0):
+        self.head = head
+        self.tail = tail
+        self.size = 0
+        self.sent = []
+        self.sent_size = 0
+        self.spool = None
+        self.tail_text = ''
+
+    @classmethod
+    def from_options(cls, options):
+        limit = options.get('output_limit')
+        if limit is None:
+            return cls(*output_limit)
+        return cls(limit.get('head', 0), limit.get('tail', 0))
+
+    def feed(self, text):
+        """ returns the part of text to send now """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.size += len(text)
+        if self.spool is not None:
+            self.spool.write(text)
+            self.keep_tail(text)
+            return ''
+        if not self.head or self.size <= self.head:
+            if self.head:
+                self.sent.append(text)
+            self.sent_size += len(text)
+            return text
+
+        # stop at the end of a line where there is one
+        cut = text.rfind('\n', 0, self.head - self.sent_size) + 1
+        if not cut:
+            cut = utf8_boundary(text, self.head - self.sent_size)
+        self.sent.append(text[:cut])
+        self.sent_size += cut
+        self.spool = output_store.spool()
+        for piece in self.sent:
+            self.spool.write(piece)
+        self.sent = None
+        self.spool.write(text[cut:])
+        self.keep_tail(text[cut:])
+        return text[:cut]
+
+    def keep_tail(self, text):
+        if self.tail:
+            self.tail_text = (self.tail_text + text)[-self.tail:]
+
+    def finish(self):
+        """
+            None if all the output was sent, otherwise (info, tail), info
+            being the MSG_TRUNCATED dict and tail the text to send after it
+        """
+        if self.spool is None:
+            return None
+        # start at a line, or failing that at a whole utf-8 sequence
+        tail = self.tail_text
+        start = tail.find('\n', 0, len(tail) - 1) + 1
+        while start < len(tail) and ord(tail[start]) & 0xC0 == 0x80:
+            start += 1
+        tail = tail[start:]
+        info = {
+            'handle': output_store.add(self.spool),
+            'size': self.size,
+            'omitted': self.size - self.sent_size - len(tail)
+        }
+        self.spool = None
+        return (info, tail)
+
+    def limit(self, msgtype, payload):
+        """ the (msgtype, payload) to send now or None, only text is limited """
+        if msgtype in (MSG_STREAM, MSG_RESULT):
+            payload = self.feed(payload)
+            if not payload and self.spool is not None:
+                return None
+        return (msgtype, payload)
+
+    def trailer(self):
+        """ the frames to send after the output, if it was truncated """
+        truncated = self.finish()
+        if truncated is None:
+            return []
+        (info, tail) = truncated
+        frames = [(MSG_TRUNCATED, dumps(info))]
+        if tail:
+            frames.append((MSG_STREAM, tail))
+        return frames
+
+    def note(self):
+        """
+            for buffered replies, once all the output has been fed, a note
+            of what was left out followed by the tail or '' if nothing was
+        """
+        truncated = self.finish()
+        if truncated is None:
+            return ''
+        (info, tail) = truncated
+        return "\n[... %d bytes omitted, the full %d bytes are output %d ...]\n%s" % (
+            info['omitted'], info['size'], info['handle'], tail)
+
+def fetch_output(payload):
+    """ answers a MSG_FETCH, returns (msgtype, payload) """
+    request = loads(payload)
+    data = output_store.read(request['handle'], request.get('offset', 0), request.get('length', -1))
+    if data is None:
+        return (MSG_ERROR, "output %s is no longer available" % request['handle'])
+    return (MSG_OK, data)
+
+def execute_code(km, code):
+    code = strip_comment_lines(code)
+    return km.shell_channel.execute(code)
+
+def execute(kernel, code, capture = None, request = None):
+    request = kernel.execute(code, request)
+    return get_response(request, capture)
+
+def stream_execute(kernel, code, send, mimetypes = None, capture = None, request = None):
+    """
+        executes code calling send(msgtype, payload) for each piece of
+        output as it arrives, send blocks while the client is slow and
+        output arriving in the meantime is coalesced. Results and displays
+        are sent as mime_frames(), text beyond the capture's limit is held
+        back. Returns the error or None.
+    """
+    return stream_response(kernel.execute(code, request), send, mimetypes, capture)
+
+def stream_response(request, send, mimetypes = None, capture = None):
+    """ the part of stream_execute() after the code has been queued """
+    if capture is None:
+        capture = OutputCapture()
+    error = None
+    try:
+        for (kind, data) in iter_response(request):
+            if kind == 'stream':
+                frames = [(MSG_STREAM, data)]
+            elif kind in ('result', 'display'):
+                frames = mime_frames(kind, data, mimetypes)
+            else:
+                error = data
+                frames = [(MSG_ERROR, error['error'])]
+            for frame in frames:
+                frame = capture.limit(*frame)
+                if frame is not None:
+                    send(*frame)
+    except RequestAbandoned:
+        if not request.timed_out:
+            raise
+    for frame in capture.trailer():
+        send(*frame)
+    if request.timed_out:
+        error = {'error': timeout_message(request)}
+        send(MSG_TIMEOUT, error['error'])
+    return error
+
+def stream_batch(batch, cells, send, mimetypes, options):
+    """
+        runs a Batch's cells, sending MSG_CELL ahead of each cell's output,
+        which is streamed as by stream_execute(). The execute options
+        apply to each cell, its timeout counting from when the cell before
+        finished. Returns (success, number of cells run).
+    """
+    timeout = options.get('timeout', execute_timeout)
+    batch.submit(cells)
+    success = True
+    ran = 0
+    for (index, request) in enumerate(batch.requests):
+        if batch.is_cancelled(request):
+            break
+        request.set_deadline(timeout, options.get('on_timeout', 'abandon'))
+        # announced with its first output, other executes may run before it
+        announce = [index]
+        def send_cell(msgtype, payload):
+            if announce:
+                send(MSG_CELL, dumps({'index': announce.pop()}))
+            send(msgtype, payload)
+        try:
+            error = stream_response(request, send_cell, mimetypes, OutputCapture.from_options(options))
+        except RequestAbandoned:
+            if batch.is_cancelled(request):
+                break
+            raise
+        ran += 1
+        if error is not None:
+            success = False
+            if request.timed_out or batch.stop_on_error:
+                batch.stop()
+    return (success and ran == len(cells), ran)
+
+def timeout_message(request):
+    if request.started_at is None and request.leader is None:
+        return "timed out after %.3gs waiting for the kernel" % request.timeout
+    if not request.abandoned:
+        return "timed out after %.3gs, the kernel was interrupted" % request.timeout
+    if request.timeout_policy == 'interrupt':
+        return "timed out after %.3gs, the kernel didn't stop when interrupted" % request.timeout
+    return "timed out after %.3gs, the kernel is still running it" % request.timeout
+    
+# magic object info
+
+def get_object_info(kernel, word):
+    request = kernel.track(lambda: kernel.km.shell_channel.object_info(word))
+    response = get_response(request)
+    return response[0]
+
+# http://stackoverflow.com/a/3229493/31480
+def pretty(d, indent=0):
+   for key, value in d.iteritems():
+      logging.info('\t' * indent + str(key))
+      if isinstance(value, dict):
+         pretty(value, indent+1)
+      else:
+         logging.info( '\t' * (indent+1) + str(value))
+
+
+# lifecycle
+
+class Lifecycle(object):
+    """
+        decides when the server stops. With an idle timeout a Timer fires at
+        the deadline, waits out the rest if there was activity since and
+        never stops the server while requests are in flight. drain(), on
+        SIGTERM, has the kernel pool turn new requests away and stops once
+        those in flight have finished, or drain_timeout seconds have passed.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.idle_timeout = 0
+        self.drain_timeout = 0
+        self.lock = Lock()
+        self.in_flight = 0
+        self.last_activity = time()
+        self.timer = None
+        self.draining = False
+        self.stopping = False
+
+    def start(self, server, idle_timeout = 0, drain_timeout = 0):
+        with self.lock:
+            self.server = server
+            self.idle_timeout = idle_timeout
+            self.drain_timeout = drain_timeout
+            self.last_activity = time()
+            self.schedule(idle_timeout)
+
+    def schedule(self, delay):
+        # with the lock held
+        if self.idle_timeout > 0 and self.timer is None and not self.stopping:
+            self.timer = Timer(delay, self.on_idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def touch(self):
+        """ a client did something, moves the idle deadline on """
+        with self.lock:
+            self.last_activity = time()
+
+    def begin(self):
+        """ a request has started, call end() once it has been answered """
+        with self.lock:
+            self.in_flight += 1
+            self.last_activity = time()
+
+    def end(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.last_activity = time()
+            if self.in_flight > 0:
+                return
+            if not self.draining:
+                self.schedule(self.idle_timeout)
+                return
+        logging.info("drained, exiting")
+        self.stop()
+
+    def on_idle(self):
+        with self.lock:
+            self.timer = None
+            if self.in_flight > 0 or self.stopping:
+                # end() starts another
+                return
+            remaining = self.last_activity + self.idle_timeout - time()
+            if remaining > 0:
+                self.schedule(remaining)
+                return
+        logging.warn("Server is timed out. exiting")
+        self.stop()
+
+    def drain(self):
+        with self.lock:
+            if self.draining or self.server is None:
+                return
+            self.draining = True
+            in_flight = self.in_flight
+        kernel_pool.closing = True
+        if in_flight == 0:
+            return self.stop()
+        logging.info("draining %d requests" % in_flight)
+        if self.drain_timeout > 0:
+            timer = Timer(self.drain_timeout, self.stop)
+            timer.daemon = True
+            timer.start()
+
+    def stop(self):
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        # a threaded_server's shutdown() waits for serve_forever() to
+        # return, which could be on this thread
+        thread = Thread(target = self.server.shutdown)
+        thread.daemon = True
+        thread.start()
+
+lifecycle = Lifecycle()
+
+def terminate(signal_number, stack_frame):
+    """
+        SIGTERM handler, drains on a thread of its own as the signal may
+        have interrupted one holding the lifecycle's lock
+    """
+    thread = Thread(target = lifecycle.drain)
+    thread.daemon = True
+    thread.start()
+
+
+def threaded_server(address, unix = False, bind = True):
+    """
+        a server with a thread per client, SocketServer is imported here as
+        the EventLoopServer has no use for it
+    """
+    import SocketServer
+
+    if unix:
+        base = SocketServer.UnixStreamServer
+    else:
+        base = SocketServer.TCPServer
+
+    class ThreadedServer(SocketServer.ThreadingMixIn, base):
+
+        timeout = 300
+        allow_reuse_address = not unix
+        request_queue_size = 128
+        # idle clients don't keep the daemon alive, see Lifecycle
+        daemon_threads = True
+
+    return ThreadedServer(address, IPythonRequestHandler, bind_and_activate = bind)
+
+
+class IPythonRequestHandler(object):
+    """
+        serves one client of a threaded_server(), which creates one of
+        these per connection like a SocketServer.BaseRequestHandler
+    """
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.handle()
+
+    def handle(self):
+        connection = Connection(self.request, verbose = verbose)
+        # KernelRequests in flight by request id, for MSG_INTERRUPT
+        self.requests = {}
+        self.requests_lock = Lock()
+        try:
+            while 1:
+                (msgtype, request_id, flags, msg) = connection.read_frame()
+                lifecycle.touch()
+
+                logging.debug( "[%i] [%i] [%s]" % (msgtype, request_id, msg))
+                if msgtype == MSG_HELLO:
+                    version = connection.accept_hello(msg, compression_codecs)
+                    logging.debug("negotiated protocol version %d, compression %s" % (
+                        version, connection.compression))
+                elif msgtype == MSG_FETCH:
+                    (reply, payload) = fetch_output(msg)
+                    connection.write_frame(reply, payload, request_id)
+                elif msgtype == MSG_STATS:
+                    connection.write_frame(MSG_OK, dumps(kernel_pool.stats()), request_id)
+                elif msgtype == MSG_INTERRUPT:
+                    with self.requests_lock:
+                        request = self.requests.get(request_id)
+                    error = interrupt_request(request, request_id)
+                    if error is not None:
+                        connection.write_frame(MSG_ERROR, error, request_id)
+                elif msgtype == MSG_BATCH:
+                    if connection.version < 2:
+                        connection.write_frame(MSG_ERROR, "batches need protocol version 2", request_id)
+                        continue
+                    thread = Thread(target = self.batch_request,
+                                    args = (connection, request_id, flags, msg))
+                    thread.daemon = True
+                    thread.start()
+                elif msgtype == MSG_EXECUTE:
+                    if connection.version >= 2:
+                        # pipelined, the reply carries the request id so it
+                        # can go back in any order
+                        thread = Thread(target = self.execute_request,
+                                        args = (connection, request_id, flags, msg))
+                        thread.daemon = True
+                        thread.start()
+                    else:
+                        self.execute_request(connection, request_id, flags, msg)
+                else:
+                    raise RuntimeError("unknown msgtype : %s" % str(msgtype))
+        except SocketDisconnected:
+            logging.info("Client disconnected")
+
+    def execute_request(self, connection, request_id, flags, msg):
+        def send(msgtype, payload):
+            connection.write_frame(msgtype, payload, request_id)
+
+        options, code = unpack_options(flags, msg)
+        selector = KernelSelector.from_options(options.get('kernel'))
+        capture = OutputCapture.from_options(options)
+        request = KernelRequest(None)
+        request.configure(options)
+        with self.requests_lock:
+            self.requests[request_id] = request
+        lifecycle.begin()
+        try:
+            if flags & FLAG_STREAM:
+                self.stream_request(send, selector, code, options.get('mime'), capture, request)
+            else:
+                self.buffered_request(send, selector, code, capture, request)
+        except (SocketDisconnected, socket.error):
+            logging.info("Client disconnected before request %i completed" % request_id)
+        finally:
+            with self.requests_lock:
+                self.requests.pop(request_id, None)
+            lifecycle.end()
+
+    def batch_request(self, connection, request_id, flags, msg):
+        def send(msgtype, payload):
+            connection.write_frame(msgtype, payload, request_id)
+
+        options, cells = unpack_options(flags, msg)
+        try:
+            cells = loads(cells)
+        except ValueError:
+            send( MSG_ERROR, "a batch is a json list of cells" )
+            send( MSG_DONE, dumps({'success': False, 'ran': 0}) )
+            return
+        batch = None
+        success, ran = False, 0
+        lifecycle.begin()
+        try:
+            kernel = kernel_pool.get(KernelSelector.from_options(options.get('kernel')))
+            requests = []
+            for code in cells:
+                request = KernelRequest(None)
+                request.priority = request_priority(options.get('priority', 'batch'))
+                requests.append(request)
+            batch = Batch(kernel, requests, options.get('stop_on_error', True))
+            with self.requests_lock:
+                self.requests[request_id] = batch
+            (success, ran) = stream_batch(batch, cells, send, options.get('mime'), options)
+            send( MSG_DONE, dumps({'success': success, 'ran': ran}) )
+        except IPythonNotFoundException as e:
+            send( MSG_ERROR, str(e.value) )
+            send( MSG_DONE, dumps({'success': False, 'ran': ran}) )
+        except (SocketDisconnected, socket.error):
+            logging.info("Client disconnected before batch %i completed" % request_id)
+        finally:
+            if batch is not None:
+                batch.stop()
+            with self.requests_lock:
+                self.requests.pop(request_id, None)
+            lifecycle.end()
+        logging.debug( "[complete] [%i] [%s] [%d cells]" % (request_id, success, ran))
+
+    def buffered_request(self, send, selector, msg, capture, request):
+        try:
+            out, error = execute(kernel_pool.get(selector), msg, capture, request)
+        except IPythonNotFoundException as e:
+            out, error = '', {'error': str(e.value)}
+        logging.debug( "[complete] [%s] [%s]" % (out, error))
+
+        if request.timed_out:
+            send( MSG_TIMEOUT, out + capture.note() )
+        elif error is None:
+            send( MSG_OK, out + capture.note() )
+        else:
+            send( MSG_ERROR, error['error'] )
+
+    def stream_request(self, send, selector, msg, mimetypes, capture, request):
+        try:
+            error = stream_execute(kernel_pool.get(selector), msg, send, mimetypes, capture, request)
+        except IPythonNotFoundException as e:
+            error = {'error': str(e.value)}
+            send( MSG_ERROR, error['error'] )
+        logging.debug( "[complete] [%s]" % error)
+
+        send( MSG_DONE, dumps({'success': error is None}) )
+
+
+def interrupt_request(request, request_id):
+    """ answers a MSG_INTERRUPT, returns an error message if it couldn't be done """
+    if request is None:
+        logging.info("no request %i to interrupt" % request_id)
+        return None
+    logging.info("interrupting request %i" % request_id)
+    try:
+        request.interrupt()
+    except IPythonNotFoundException as e:
+        return "couldn't interrupt : %s" % e.value
+    except OSError as e:
+        return "couldn't interrupt : %s" % e
+    return None
+
+
+def write_ready_file(options, status):
+    """
+        tells the plugin waiting on us that we are listening ("ready") or
+        have given up ("error <message>")
+    """
+    if options.ready_file is None:
+        return
+    tmp = options.ready_file + '.tmp'
+    if os.path.lexists(tmp):
+        remove(tmp)
+    # a new file of our own, not something the path was made to point at
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(status + '\n')
+    if exists(options.ready_file) and sys.platform == 'win32':
+        remove(options.ready_file)
+    rename(tmp, options.ready_file)
+
+# event loop server
+
+class LoopRequest(KernelRequest):
+    """
+        a request made through the EventLoopServer, the kernel's
+        dispatcher thread hands each message over to the loop rather than
+        queueing it for a waiting thread
+    """
+
+    def __init__(self, server, client, request_id, streaming, mimetypes = None, capture = None):
+        KernelRequest.__init__(self, None)
+        self.server = server
+        self.client = client
+        self.request_id = request_id
+        self.streaming = streaming
+        self.mimetypes = mimetypes
+        self.capture = capture if capture is not None else OutputCapture()
+        self.out = []
+        self.error = None
+        self.timer = None
+        self.finished = False
+
+    def put(self, msg):
+        self.server.call_soon(self.on_msg, msg)
+
+    def start_deadline(self):
+        if self.deadline is None:
+            return
+        self.timer = Timer(self.deadline - time(), self.server.call_soon, [self.on_deadline])
+        self.timer.daemon = True
+        self.timer.start()
+
+    def on_deadline(self):
+        if not self.finished:
+            self.time_out()
+
+    def on_msg(self, msg):
+        if self.finished:
+            return
+        if msg is None:
+            return self.fail("lost connection to kernel")
+        if isinstance(msg, IPythonNotFoundException):
+            if self.timed_out:
+                return self.finish()
+            return self.fail(msg.value)
+
+        event = response_event(msg)
+        if event is None:
+            return
+        kind, data = event
+        if kind == 'idle':
+            self.finish()
+        elif kind == 'error':
+            self.error = data
+            if self.streaming:
+                self.send(MSG_ERROR, data['error'])
+        elif kind == 'stream':
+            if self.streaming:
+                self.send_limited(MSG_STREAM, data)
+            else:
+                self.out.append(self.capture.feed(data))
+        elif self.streaming:
+            for (msgtype, payload) in mime_frames(kind, data, self.mimetypes):
+                self.send_limited(msgtype, payload)
+        elif kind == 'result':
+            self.out.append(self.capture.feed(data.get('text/plain', '')))
+
+    def fail(self, message):
+        self.error = {'error': message}
+        if self.streaming:
+            self.send(MSG_ERROR, message)
+        self.finish()
+
+    def finish(self):
+        logging.debug( "[complete] [%i] [%s]" % (self.request_id, self.error))
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.client.requests.pop(self.request_id, None)
+        if self.streaming:
+            self.send_trailer()
+            self.send(MSG_DONE, dumps({'success': self.error is None}))
+        elif self.timed_out:
+            self.send(MSG_TIMEOUT, ''.join(self.out) + self.capture.note())
+        elif self.error is None:
+            self.send(MSG_OK, ''.join(self.out) + self.capture.note())
+        else:
+            self.send(MSG_ERROR, self.error['error'])
+        lifecycle.end()
+
+    def send_trailer(self):
+        for frame in self.capture.trailer():
+            self.send(*frame)
+        if self.timed_out:
+            self.error = {'error': timeout_message(self)}
+            self.send(MSG_TIMEOUT, self.error['error'])
+
+    def send(self, msgtype, payload):
+        self.client.send_frame(msgtype, payload, self.request_id)
+
+    def send_limited(self, msgtype, payload):
+        frame = self.capture.limit(msgtype, payload)
+        if frame is not None:
+            self.send(*frame)
+
+
+class LoopCell(LoopRequest):
+    """ a cell of a LoopBatch, streamed under the batch's request id """
+
+    def __init__(self, batch, index, mimetypes, capture):
+        LoopRequest.__init__(self, batch.server, batch.client, batch.request_id, True,
+                             mimetypes, capture)
+        self.index = index
+        self.announced = False
+
+    def on_msg(self, msg):
+        # dropped cells never started and have nothing to say
+        if not self.batch.is_cancelled(self):
+            LoopRequest.on_msg(self, msg)
+
+    def finish(self):
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.send_trailer()
+        self.batch.cell_done(self)
+
+    def send(self, msgtype, payload):
+        if not self.announced:
+            self.announced = True
+            LoopRequest.send(self, MSG_CELL, dumps({'index': self.index}))
+        LoopRequest.send(self, msgtype, payload)
+
+
+class LoopBatch(Batch):
+    """
+        a Batch made through the EventLoopServer. Cells report to it as they
+        finish and the timeout of the next counts from then, as with
+        stream_batch()
+    """
+
+    def __init__(self, server, client, request_id, kernel, cells, options):
+        self.server = server
+        self.client = client
+        self.request_id = request_id
+        self.options = options
+        requests = []
+        for index in range(len(cells)):
+            cell = LoopCell(self, index, options.get('mime'), OutputCapture.from_options(options))
+            cell.priority = request_priority(options.get('priority', 'batch'))
+            requests.append(cell)
+        Batch.__init__(self, kernel, requests, options.get('stop_on_error', True))
+        self.current = None
+        self.success = True
+        self.ran = 0
+        self.finished = False
+
+    def start(self, cells):
+        self.submit(cells)
+        self.next_cell(0)
+
+    def next_cell(self, index):
+        if index >= len(self.requests) or self.is_cancelled(self.requests[index]):
+            return self.finish()
+        self.current = self.requests[index]
+        self.current.set_deadline(self.options.get('timeout', execute_timeout),
+                                  self.options.get('on_timeout', 'abandon'))
+        self.current.start_deadline()
+
+    def cell_done(self, cell):
+        self.ran += 1
+        if cell.error is not None:
+            self.success = False
+            if cell.timed_out or self.stop_on_error:
+                self.stop()
+        self.next_cell(cell.index + 1)
+
+    def interrupt(self):
+        Batch.interrupt(self)
+        if self.current is not None and self.is_cancelled(self.current):
+            # it was still queued behind another execute
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        for cell in self.requests:
+            if cell.timer is not None:
+                cell.timer.cancel()
+        self.client.requests.pop(self.request_id, None)
+        success = self.success and self.ran == len(self.requests)
+        self.client.send_frame(MSG_DONE, dumps({'success': success, 'ran': self.ran}),
+                               self.request_id)
+        lifecycle.end()
+
+
+class LoopClient(object):
+    """
+        a client socket of the EventLoopServer, only used on the loop's
+        thread. Once more than high_water bytes are waiting for a client
+        that is slow to read, the rest go to a temporary file and are read
+        back as the socket drains.
+    """
+
+    high_water = 1024 * 1024
+    # bytes read back from the spool at a time
+    unspool_size = 64 * 1024
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.sock.setblocking(0)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, AttributeError):
+            pass
+        self.parser = FrameParser()
+        self.version = 1
+        self.compression = None
+        # LoopRequests in flight by request id, for MSG_INTERRUPT
+        self.requests = {}
+        self.outbuf = deque()
+        self.outpos = 0
+        # bytes in outbuf
+        self.buffered = 0
+        self.spool = None
+        self.spool_read = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send_frame(self, msgtype, payload, request_id = 0, version = None):
+        if self.closed:
+            return
+        if version is None:
+            version = self.version
+        flags = 0
+        if version >= 2:
+            payload, flags = compress_payload(self.compression, payload, flags)
+        header = pack_header(version, msgtype, len(payload), request_id, flags)
+        if self.spool is not None or \
+                (self.outbuf and self.buffered + len(header) + len(payload) > self.high_water):
+            return self.spool_frame(header, payload)
+        was_idle = not self.outbuf
+        self.outbuf.append(header)
+        self.outbuf.append(payload)
+        self.buffered += len(header) + len(payload)
+        if was_idle:
+            self.server.update(self)
+
+    def spool_frame(self, header, payload):
+        if self.spool is None:
+            from tempfile import TemporaryFile
+            logging.debug("spooling output for a slow client")
+            self.spool = TemporaryFile()
+            self.spool_read = 0
+        self.spool.seek(0, 2)
+        self.spool.write(header)
+        self.spool.write(payload)
+
+    def unspool(self):
+        """ moves the next spooled bytes to outbuf, False once there are none """
+        if self.spool is None:
+            return False
+        self.spool.seek(self.spool_read)
+        data = self.spool.read(self.unspool_size)
+        if not data:
+            self.spool.close()
+            self.spool = None
+            return False
+        self.spool_read += len(data)
+        self.outbuf.append(data)
+        self.buffered += len(data)
+        return True
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            return self.close()
+        if not data:
+            logging.info("Client disconnected")
+            return self.close()
+
+        self.parser.feed(data)
+        try:
+            for (msgtype, request_id, flags, msg) in self.parser.frames():
+                self.handle_frame(msgtype, request_id, flags, msg)
+                if self.closed:
+                    return
+        except Exception:
+            # the stream can't be followed past this
+            logging.exception("unreadable frame from a client, closing it")
+            self.close()
+
+    def handle_frame(self, msgtype, request_id, flags, msg):
+        """ a frame that can't be handled fails its request, not the loop """
+        try:
+            self.server.handle_frame(self, msgtype, request_id, flags, msg)
+        except Exception as e:
+            logging.exception("error handling a frame")
+            if not request_id:
+                return self.close()
+            self.send_frame(MSG_ERROR, "couldn't handle the request : %s" % e, request_id)
+            if flags & FLAG_STREAM:
+                self.send_frame(MSG_DONE, dumps({'success': False}), request_id)
+
+    def on_writable(self):
+        while self.outbuf or self.unspool():
+            chunk = self.outbuf[0]
+            try:
+                sent = self.sock.send(buffer(chunk, self.outpos))
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                return self.close()
+            self.outpos += sent
+            if self.outpos < len(chunk):
+                return
+            self.outbuf.popleft()
+            self.buffered -= len(chunk)
+            self.outpos = 0
+        self.server.update(self)
+
+    def flush(self, timeout = 5):
+        """ sends what is still queued, blocking, once the loop has stopped """
+        if self.closed:
+            return
+        self.sock.settimeout(timeout)
+        try:
+            while self.outbuf or self.unspool():
+                self.sock.sendall(buffer(self.outbuf.popleft(), self.outpos))
+                self.outpos = 0
+        except socket.error:
+            pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.outbuf.clear()
+            self.buffered = 0
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+            self.server.remove(self)
+            self.sock.close()
+
+
+class EventLoopServer(object):
+    """
+        single threaded alternative to threaded_server(), one poll loop
+        reads and writes every client socket. Kernel output reaches the
+        loop from each kernel's dispatcher thread through call_soon, which
+        wakes it with a byte on a socket pair, so the only other threads
+        are one per kernel rather than one per client.
+    """
+
+    def __init__(self, server_address, family = socket.AF_INET, sock = None):
+        self.server_address = server_address
+        if sock is not None:
+            # already listening, see inherited_socket()
+            self.socket = sock
+        else:
+            self.socket = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_INET:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(128)
+        self.socket.setblocking(0)
+        self.wake_recv, self.wake_send = wake_pair()
+        self.wake_recv.setblocking(0)
+        self.clients = {}
+        self.callbacks = []
+        self.callbacks_lock = Lock()
+        self.running = False
+        # see with_kernel()
+        self.lookups = Queue()
+        self.lookups_pending = 0
+        self.lookup_thread = None
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.socket.fileno(), select.POLLIN)
+            self.poller.register(self.wake_recv.fileno(), select.POLLIN)
+        else:
+            self.poller = None
+
+    def call_soon(self, callback, *args):
+        """ runs callback(*args) on the loop's thread, callable from any thread """
+        with self.callbacks_lock:
+            self.callbacks.append((callback, args))
+            wake = len(self.callbacks) == 1
+        if wake:
+            try:
+                self.wake_send.send('x')
+            except socket.error:
+                pass
+
+    def with_kernel(self, selector, callback, errback):
+        """
+            calls callback(kernel) or errback(message) on the loop's thread.
+            Finding and connecting a kernel can mean probing ports and
+            waiting on IPython's import, so unless it is already connected
+            that happens on a lookup thread. Lookups finish in order, so
+            executes still reach the kernel in the order they came in.
+        """
+        if self.lookups_pending == 0:
+            kernel = kernel_pool.connected(selector)
+            if kernel is not None:
+                return callback(kernel)
+        self.lookups_pending += 1
+        if self.lookup_thread is None:
+            self.lookup_thread = Thread(target = self.run_lookups)
+            self.lookup_thread.daemon = True
+            self.lookup_thread.start()
+        self.lookups.put((selector, callback, errback))
+
+    def run_lookups(self):
+        while True:
+            (selector, callback, errback) = self.lookups.get()
+            try:
+                self.call_soon(self.looked_up, callback, kernel_pool.get(selector))
+            except IPythonNotFoundException as e:
+                self.call_soon(self.looked_up, errback, str(e.value))
+            except Exception as e:
+                logging.exception("error finding a kernel")
+                self.call_soon(self.looked_up, errback, "error finding a kernel : %s" % e)
+
+    def looked_up(self, callback, result):
+        self.lookups_pending -= 1
+        callback(result)
+
+    def update(self, client):
+        # poll for writable only while there is something to write
+        if self.poller is not None and not client.closed:
+            events = select.POLLIN | (select.POLLOUT if client.outbuf else 0)
+            self.poller.modify(client.fileno(), events)
+
+    def remove(self, client):
+        self.clients.pop(client.fileno(), None)
+        if self.poller is not None:
+            self.poller.unregister(client.fileno())
+
+    def wait(self, timeout):
+        """ returns [(fd, readable, writable)] """
+        if self.poller is not None:
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            return [(fd, bool(event & (select.POLLIN | select.POLLHUP | select.POLLERR)),
+                     bool(event & select.POLLOUT)) for fd, event in events]
+
+        readers = [self.socket, self.wake_recv] + self.clients.values()
+        writers = [client for client in self.clients.values() if client.outbuf]
+        try:
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        readable = set(r.fileno() for r in readable)
+        writable = set(w.fileno() for w in writable)
+        return [(fd, fd in readable, fd in writable) for fd in readable | writable]
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            for fd, readable, writable in self.wait(1.0):
+                if fd == self.socket.fileno():
+                    self.accept()
+                elif fd == self.wake_recv.fileno():
+                    self.drain_wake()
+                else:
+                    client = self.clients.get(fd)
+                    if client is not None and readable:
+                        client.on_readable()
+                    if client is not None and writable and not client.closed:
+                        client.on_writable()
+            self.run_callbacks()
+
+    def shutdown(self):
+        self.running = False
+        self.call_soon(lambda: None)
+
+    def server_close(self):
+        """ after serve_forever(), replies written since the last poll still go out """
+        for client in self.clients.values():
+            client.flush()
+            client.close()
+        self.socket.close()
+        self.wake_recv.close()
+        self.wake_send.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            client = LoopClient(self, sock)
+            self.clients[client.fileno()] = client
+            if self.poller is not None:
+                self.poller.register(client.fileno(), select.POLLIN)
+
+    def drain_wake(self):
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def run_callbacks(self):
+        with self.callbacks_lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("error in event loop callback")
+
+    def handle_frame(self, client, msgtype, request_id, flags, msg):
+        lifecycle.touch()
+
+        logging.debug( "[%i] [%i] [%s]" % (msgtype, request_id, msg))
+        if msgtype == MSG_HELLO:
+            (version, compression, reply) = negotiate_version(msg, compression_codecs)
+            client.send_frame(MSG_HELLO, reply, version = 1)
+            client.version = client.parser.version = version
+            client.compression = client.parser.compression = compression
+            logging.debug("negotiated protocol version %d, compression %s" % (version, compression))
+        elif msgtype == MSG_FETCH:
+            client.send_frame(*fetch_output(msg), request_id = request_id)
+        elif msgtype == MSG_STATS:
+            client.send_frame(MSG_OK, dumps(kernel_pool.stats()), request_id = request_id)
+        elif msgtype == MSG_INTERRUPT:
+            error = interrupt_request(client.requests.get(request_id), request_id)
+            if error is not None:
+                client.send_frame(MSG_ERROR, error, request_id)
+        elif msgtype == MSG_EXECUTE:
+            options, code = unpack_options(flags, msg)
+            selector = KernelSelector.from_options(options.get('kernel'))
+            request = LoopRequest(self, client, request_id, bool(flags & FLAG_STREAM),
+                                  options.get('mime'), OutputCapture.from_options(options))
+            request.configure(options)
+            request.start_deadline()
+            client.requests[request_id] = request
+            lifecycle.begin()
+
+            # it may have timed out while a kernel was found
+            def submit(kernel):
+                if not request.finished:
+                    kernel.execute(code, request)
+
+            def fail(error):
+                if not request.finished:
+                    request.fail(error)
+
+            self.with_kernel(selector, submit, fail)
+        elif msgtype == MSG_BATCH:
+            if client.version < 2:
+                client.send_frame(MSG_ERROR, "batches need protocol version 2", request_id)
+                return
+            options, cells = unpack_options(flags, msg)
+            try:
+                cells = loads(cells)
+            except ValueError:
+                client.send_frame(MSG_ERROR, "a batch is a json list of cells", request_id)
+                client.send_frame(MSG_DONE, dumps({'success': False, 'ran': 0}), request_id)
+                return
+
+            def start(kernel):
+                batch = LoopBatch(self, client, request_id, kernel, cells, options)
+                client.requests[request_id] = batch
+                batch.start(cells)
+
+            def fail(error):
+                client.send_frame(MSG_ERROR, error, request_id)
+                client.send_frame(MSG_DONE, dumps({'success': False, 'ran': 0}), request_id)
+                lifecycle.end()
+
+            # LoopBatch.finish() ends it
+            lifecycle.begin()
+            self.with_kernel(KernelSelector.from_options(options.get('kernel')), start, fail)
+        else:
+            logging.error("unknown msgtype : %s" % str(msgtype))
+            client.close()
+
+def wake_pair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # windows, pair up over loopback
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    send = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    send.connect(listener.getsockname())
+    recv, _ = listener.accept()
+    listener.close()
+    return recv, send
+
+
+def prepare_unix_socket(path):
+    """
+        creates the socket's directory readable by its owner only and
+        clears out a socket left behind by a daemon that has gone away.
+        Refuses a directory someone else could have put a socket in.
+    """
+    directory = dirname(path)
+    if not exists(directory):
+        makedirs(directory, 0700)
+        chmod(directory, 0700)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise socket.error(errno.EPERM, "%s isn't a directory private to this user" % directory)
+    if exists(path):
+        if check_unix_socket_open(path):
+            raise socket.error(errno.EADDRINUSE, "a daemon is already listening on %s" % path)
+        remove(path)
+
+def check_unix_socket_open(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        status = True
+    except socket.error:
+        status = False
+    s.close()
+    return status
+
+# the first descriptor passed with LISTEN_FDS, as systemd does it
+LISTEN_FDS_START = 3
+
+def inherited_listen_fd(options):
+    """
+        the descriptor of a listening socket handed down by whoever started
+        us, from --listen-fd or systemd style LISTEN_FDS and LISTEN_PID.
+        None if we are to bind our own. Call before daemonising, LISTEN_PID
+        is the pid we started with.
+    """
+    if options.listen_fd is not None:
+        return options.listen_fd
+    if environ.get('LISTEN_PID') == str(getpid()) and int(environ.get('LISTEN_FDS', 0)) > 0:
+        del environ['LISTEN_PID']
+        del environ['LISTEN_FDS']
+        return LISTEN_FDS_START
+    return None
+
+def inherited_socket(options):
+    """
+        the socket for options.listen_fd. Connections made since it
+        started listening have been queued by the os and are served once
+        the server is up.
+    """
+    family = socket.AF_UNIX if options.unix_socket is not None else socket.AF_INET
+    sock = socket.fromfd(options.listen_fd, family, socket.SOCK_STREAM)
+    # fromfd works on a copy
+    close(options.listen_fd)
+    return sock
+
+def adopt_socket(sock, unix):
+    """ a threaded_server() on sock rather than a socket of its own """
+    server = threaded_server(sock.getsockname(), unix, bind = False)
+    server.socket.close()
+    server.socket = sock
+    return server
+
+def create_server(options):
+    if options.listen_fd is not None:
+        sock = inherited_socket(options)
+        if options.event_loop:
+            server = EventLoopServer(sock.getsockname(), sock = sock)
+        else:
+            server = adopt_socket(sock, options.unix_socket is not None)
+        logging.info("Listing on inherited socket %s" % (sock.getsockname(),))
+    elif options.unix_socket is not None:
+        prepare_unix_socket(options.unix_socket)
+        if options.event_loop:
+            server = EventLoopServer(options.unix_socket, socket.AF_UNIX)
+        else:
+            server = threaded_server(options.unix_socket, unix = True)
+        chmod(options.unix_socket, 0600)
+        logging.info("Listing on %s" % options.unix_socket)
+    else:
+        if options.event_loop:
+            server = EventLoopServer(("127.0.0.1", options.port))
+        else:
+            server = threaded_server(("127.0.0.1", options.port))
+        logging.info("Listing on %d" % options.port)
+    return server
+
+def run_server(options):
+    try:
+        server = create_server(options)
+    except socket.error as e:
+        write_ready_file(options, "error unable to listen on %s : %s" % (
+                options.unix_socket or options.port, e))
+        raise
+    write_ready_file(options, "ready")
+    preload_kernel_manager()
+    lifecycle.start(server, options.server_timeout, options.drain_timeout)
+    try:
+        while 1:
+            try:
+                server.serve_forever()
+                break
+            except select.error as e:
+                # python 2.6's SocketServer doesn't retry after a signal
+                if e.args[0] != errno.EINTR:
+                    raise
+    finally:
+        server.server_close()
+        kernel_pool.close()
+        if options.unix_socket is not None and exists(options.unix_socket):
+            remove(options.unix_socket)
+        if options.ready_file is not None and exists(options.ready_file):
+            remove(options.ready_file)
+
+def main(options):
+    
+    logconfig = {'level': logging.DEBUG if options.verbose else logging.INFO }
+
+    if options.logfile is not None:
+        logconfig['filename'] = options.logfile
+    else:
+        logconfig['stream'] = sys.stdout
+
+    logging.basicConfig(**logconfig)
+    logging.debug("sys.path %s" % sys.path)
+
+    if options.server:
+        global compression_codecs, output_limit, execute_timeout
+        if not options.compression:
+            compression_codecs = []
+        output_limit = (options.output_head, options.output_tail)
+        execute_timeout = options.execute_timeout
+        run_server(options)
+    else:
+        # print options
+        if options.code is not None:
+            code = options.code
+        else:
+            code = sys.stdin.read()
+
+        verbose = options.verbose
+
+        out, error = execute(kernel_pool.get(), code)
+
+        if len( out ) > 0:
+            print "\n".join(out)    
+        if error is not None:
+            print error['error']
+            sys.exit(1)
+        else:
+            sys.exit(0)
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-c', dest = 'code', help = 'Code to send to ipython kernel')
+    parser.add_option('-v', '--verbose', dest = 'verbose', action='store_true', default=False,
+                            help = 'Output verbose debug messages')
+    parser.add_option('-s', '--server', dest = 'server', action='store_true', default=False,
+                            help = 'Ignore -c and become a server listening on a port')
+    parser.add_option('-d', '--daemon', dest = 'daemon', action='store_true', default=False,
+                            help = 'Daemonise the process')
+    parser.add_option('-p', '--port', dest = 'port', default=48721, type='int',
+                            help = 'Ignore -c and become a server listening on a port')
+    parser.add_option('--log', dest = 'logfile', default=None, 
+                            help = 'optional Log file')
+    parser.add_option('--server-timeout', dest = 'server_timeout', default=0,  type='int',
+                            help = 'number of seconds after no requests the processed the server will terminate')
+    parser.add_option('--drain-timeout', dest = 'drain_timeout', default = 30, type = 'float',
+                            help = 'seconds to let requests in flight finish after SIGTERM, 0 for as long as they take')
+    parser.add_option('--event-loop', dest = 'event_loop', action='store_true', default=False,
+                            help = 'serve every client from one event loop thread instead of a thread each')
+    parser.add_option('--unix-socket', dest = 'unix_socket', default=None,
+                            help = 'listen on this unix domain socket instead of the tcp port')
+    parser.add_option('--listen-fd', dest = 'listen_fd', default=None, type='int',
+                            help = 'serve on this inherited listening socket instead of binding, '
+                                   'a unix one with --unix-socket. LISTEN_FDS is also understood')
+    parser.add_option('--ready-file', dest = 'ready_file', default=None,
+                            help = 'file to write "ready" to once the server is listening')
+    parser.add_option('--no-compression', dest = 'compression', action='store_false', default=True,
+                            help = 'never compress large frames, even if the client offers it')
+    parser.add_option('--output-head', dest = 'output_head', default = 4 * 1024 * 1024, type = 'int',
+                            help = 'bytes of output sent for executes that set no limit, 0 for all of it')
+    parser.add_option('--output-tail', dest = 'output_tail', default = 64 * 1024, type = 'int',
+                            help = 'bytes from the end of truncated output sent after the head')
+    parser.add_option('--execute-timeout', dest = 'execute_timeout', default = 0, type = 'float',
+                            help = 'seconds before executes that set no timeout are abandoned, 0 for never')
+    (options, args) = parser.parse_args()
+    options.listen_fd = inherited_listen_fd(options)
+
+    if options.daemon:
+        import daemon
+
+        preserve = [options.listen_fd] if options.listen_fd is not None else None
+        context = daemon.DaemonContext(detach_process = True, files_preserve = preserve)
+        if options.server:
+            context.signal_map[signal.SIGTERM] = terminate
+        with context:
+            main(options)
+
+    else:
+        if options.server:
+            signal.signal(signal.SIGTERM, terminate)
+        main(options)